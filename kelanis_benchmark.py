@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Formulation benchmark: solves the same scenarios with each model formulation
+(kelanis_model.FORMULATIONS) and compares the LP relaxation bound, branch and
+bound nodes, simplex iterations and solve time read from the CBC log. Optimal
+objectives must agree between formulations; any difference is reported and
+makes the run fail.
+
+Usage:
+    python kelanis_benchmark.py [--max-down 2] [--synthetic 14,28 --samples 50] [--seed 1]
+"""
+
+import argparse
+import itertools
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+import pulp
+
+from kelanis_history import plant_equipment
+from kelanis_model import FORMULATIONS, KELANIS_PLANT, build_formulation, solve_checked
+
+LOG_PATTERNS = {
+    'relaxation': re.compile(r'^Continuous objective value is\s+(\S+)', re.M),
+    'nodes': re.compile(r'^Enumerated nodes:\s+(\d+)', re.M),
+    'iterations': re.compile(r'^Total iterations:\s+(\d+)', re.M),
+}
+
+
+def read_cbc_log(path):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        text = f.read()
+    stats = {}
+    for key, pattern in LOG_PATTERNS.items():
+        match = pattern.search(text)
+        # Missing when CBC proves infeasibility before branching
+        stats[key] = float(match.group(1)) if match else None
+    return stats
+
+
+def outage_cases(plant, max_down):
+    equipment = plant_equipment(plant)
+    return [down for n in range(max_down + 1) for down in itertools.combinations(equipment, n)]
+
+
+def solve_case(plant, down, formulation, log_path):
+    prob, _, _ = build_formulation([h for h in plant['hoppers'] if h not in down],
+                                   [r for r in plant['reclaimers'] if r not in down],
+                                   [o for o in plant['outloadings'] if o not in down],
+                                   plant, formulation)
+    start = time.perf_counter()
+    solve_checked(prob, pulp.PULP_CBC_CMD(msg=False, logPath=log_path))
+    solve_time = time.perf_counter() - start
+
+    result = read_cbc_log(log_path)
+    result.update({
+        'status': pulp.LpStatus[prob.status],
+        'objective': pulp.value(prob.objective) or 0,
+        'solve_time': solve_time,
+        'rows': len(prob.constraints),
+        'binaries': sum(1 for var in prob.variables() if var.cat == pulp.LpInteger),
+    })
+    return result
+
+
+def compare_formulations(plant, cases, formulations=tuple(FORMULATIONS)):
+    totals = {f: {'nodes': 0, 'iterations': 0, 'solve_time': 0.0, 'rows': 0, 'binaries': 0, 'gap': 0.0}
+              for f in formulations}
+    mismatches = []
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = os.path.join(tmp, 'cbc.log')
+        for down in cases:
+            results = {f: solve_case(plant, down, f, log_path) for f in formulations}
+            for f, r in results.items():
+                for key in ('nodes', 'iterations', 'solve_time', 'rows', 'binaries'):
+                    totals[f][key] += r[key] or 0
+                # Root gap: how far the LP relaxation is above the integer optimum
+                if r['status'] == 'Optimal' and r['relaxation'] is not None:
+                    totals[f]['gap'] += abs(r['relaxation']) - r['objective']
+
+            # Infeasible solves leave arbitrary values behind, so only optimal objectives are compared
+            outcomes = {f: (r['status'], round(r['objective'], 3) if r['status'] == 'Optimal' else None)
+                        for f, r in results.items()}
+            if len(set(outcomes.values())) > 1:
+                mismatches.append((down, outcomes))
+    return totals, mismatches
+
+
+def print_comparison(name, cases, totals):
+    print(f"\n{name}: {len(cases)} scenarios")
+    print(f"{'formulation':<12} {'rows':>8} {'binaries':>9} {'nodes':>8} {'iterations':>11} {'root gap':>10} "
+          f"{'solve s':>9}")
+    for f, t in totals.items():
+        print(f"{f:<12} {t['rows'] / len(cases):>8.0f} {t['binaries'] / len(cases):>9.0f} {t['nodes']:>8.0f} "
+              f"{t['iterations']:>11.0f} {t['gap'] / len(cases):>10.1f} {t['solve_time']:>9.3f}")
+
+
+def main(argv=None):
+    from kelanis_synthetic import plant_for_scale
+
+    parser = argparse.ArgumentParser(description="Compare model formulations on outage scenarios.")
+    parser.add_argument('--max-down', type=int, default=2, help="outage combinations of up to this many units")
+    parser.add_argument('--synthetic', default='', help="comma-separated synthetic plant scales to add")
+    parser.add_argument('--samples', type=int, default=50, help="scenarios sampled per synthetic plant")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    runs = [(KELANIS_PLANT, outage_cases(KELANIS_PLANT, args.max_down))]
+    rng = random.Random(args.seed)
+    for scale in [int(s) for s in args.synthetic.split(',') if s]:
+        plant = plant_for_scale(scale, seed=args.seed)
+        cases = outage_cases(plant, args.max_down)
+        runs.append((plant, rng.sample(cases, min(args.samples, len(cases)))))
+
+    failed = False
+    for plant, cases in runs:
+        totals, mismatches = compare_formulations(plant, cases)
+        print_comparison(plant['name'], cases, totals)
+        for down, outcomes in mismatches:
+            failed = True
+            print(f"  MISMATCH down={','.join(down) or '-'}: {outcomes}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
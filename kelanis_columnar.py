@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar, memory-mapped storage for sweep and batch results.
+
+A table is a directory with one fixed-width binary file per column plus
+meta.json. Columns are read through mmap without copying, so looking up one
+scenario in a multi-million-row table touches only the pages it needs.
+Rows are found by configuration bitmask through a sorted index
+(config.idx / row.idx) and a binary search on the mapped file.
+
+Column layout (little-endian, one value per row):
+    config               B  active-equipment bitmask (kelanis_history.config_mask),
+                            big-endian in config_bytes bytes per row so plants of any
+                            size fit and byte order sorts like the number
+    status               b  pulp status code (1 Optimal, -1 Infeasible, ...)
+    objective            d  total tonnage per hour
+    out:<outloading>     f  tonnage per outloading
+    edge:<source>><out>  f  tonnage per hopper/reclaimer -> outloading route
+
+Usage:
+    python kelanis_columnar.py sweep TABLE_DIR [--max-down 2] [--site NAME]
+    python kelanis_columnar.py lookup TABLE_DIR --down H3,L17
+    python kelanis_columnar.py summary TABLE_DIR
+"""
+
+import argparse
+import array
+import collections
+import heapq
+import itertools
+import json
+import mmap
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pulp
+
+from kelanis_history import config_mask, plant_equipment
+from kelanis_model import KELANIS_PLANT, outloading_tonnage, route_flows, solve_network_flow
+
+TABLE_VERSION = 2
+STATUS_CODES = {name: code for code, name in pulp.LpStatus.items()}
+
+# Rows sorted in memory at a time when building the config index
+INDEX_RUN_ROWS = 1 << 18
+
+
+def plant_routes(plant):
+    routes = [(h, o) for h in plant['hoppers'] for o in plant['allowed_flows'][h]]
+    routes += [(r, o) for r in plant['reclaimers'] for o in plant['allowed_reclaim_flows'][r]]
+    return routes
+
+
+def mask_bytes(plant):
+    return max(1, (len(plant_equipment(plant)) + 7) // 8)
+
+
+def table_columns(plant):
+    # The config column holds mask_bytes(plant) bytes per row
+    columns = [('config', 'B'), ('status', 'b'), ('objective', 'd')]
+    columns += [(f'out:{o}', 'f') for o in plant['outloadings']]
+    columns += [(f'edge:{s}>{o}', 'f') for s, o in plant_routes(plant)]
+    return columns
+
+
+class ColumnarWriter:
+    # Appends solutions in batches; close() writes meta.json and the config index
+
+    def __init__(self, path, plant=KELANIS_PLANT, batch_size=65536):
+        self.path = path
+        self.plant = plant
+        self.batch_size = batch_size
+        self.columns = table_columns(plant)
+        self.config_bytes = mask_bytes(plant)
+        os.makedirs(path, exist_ok=True)
+
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') != TABLE_VERSION or [tuple(c) for c in meta['columns']] != self.columns:
+                raise ValueError(f"{path} was written for a different plant layout or table version")
+            self.rows = meta['rows']
+        else:
+            self.rows = 0
+        self._buffers = {name: array.array(code) for name, code in self.columns}
+        self._pending = 0
+
+    def append(self, solution):
+        buffers = self._buffers
+        mask = config_mask(self.plant, solution['active_hoppers'], solution['active_reclaimers'],
+                           solution['active_outloadings'])
+        buffers['config'].frombytes(mask.to_bytes(self.config_bytes, 'big'))
+        buffers['status'].append(STATUS_CODES[solution['status']])
+        buffers['objective'].append(solution['objective'])
+        tonnage = outloading_tonnage(solution)
+        for o in self.plant['outloadings']:
+            buffers[f'out:{o}'].append(tonnage.get(o, 0))
+        routes = route_flows(solution)
+        for s, o in plant_routes(self.plant):
+            buffers[f'edge:{s}>{o}'].append(routes.get((s, o), 0))
+
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        count = self._pending
+        if not count:
+            return
+        for name, code in self.columns:
+            with open(self._column_path(name), 'ab') as f:
+                self._buffers[name].tofile(f)
+            self._buffers[name] = array.array(code)
+        self._pending = 0
+        self.rows += count
+
+    def close(self):
+        self.flush()
+        self._write_index()
+        meta = {
+            'version': TABLE_VERSION,
+            'site': self.plant['name'],
+            'rows': self.rows,
+            'equipment': plant_equipment(self.plant),
+            'config_bytes': self.config_bytes,
+            'columns': self.columns,
+        }
+        with open(os.path.join(self.path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=1)
+
+    def _column_path(self, name):
+        return column_path(self.path, name)
+
+    def _write_index(self):
+        # Sorted (config, row) pairs so lookups are a binary search on the mapped file.
+        # Runs of INDEX_RUN_ROWS are sorted in memory and merged from temporary files,
+        # so memory use does not grow with the table.
+        width = self.config_bytes
+        runs = []
+        try:
+            with open(self._column_path('config'), 'rb') as f:
+                for start in range(0, self.rows, INDEX_RUN_ROWS):
+                    data = f.read(min(INDEX_RUN_ROWS, self.rows - start) * width)
+                    # Config bytes then the big-endian row number: sorts by config, then row
+                    records = sorted(data[i * width:(i + 1) * width] + (start + i).to_bytes(8, 'big')
+                                     for i in range(len(data) // width))
+                    run = tempfile.TemporaryFile(dir=self.path)
+                    run.write(b''.join(records))
+                    run.seek(0)
+                    runs.append(run)
+
+            with open(os.path.join(self.path, 'config.idx'), 'wb') as configs, \
+                    open(os.path.join(self.path, 'row.idx'), 'wb') as rows:
+                order = array.array('Q')
+                for record in heapq.merge(*(read_records(run, width + 8) for run in runs)):
+                    configs.write(record[:width])
+                    order.append(int.from_bytes(record[width:], 'big'))
+                    if len(order) >= INDEX_RUN_ROWS:
+                        order.tofile(rows)
+                        order = array.array('Q')
+                order.tofile(rows)
+        finally:
+            for run in runs:
+                run.close()
+
+
+def read_records(f, size, block=4096):
+    # Fixed-size records from a file, read `block` records at a time
+    while True:
+        data = f.read(size * block)
+        if not data:
+            return
+        for i in range(0, len(data), size):
+            yield data[i:i + size]
+
+
+def column_path(path, name):
+    # ':' and '>' are not allowed in Windows file names
+    return os.path.join(path, name.replace(':', '__').replace('>', '--') + '.bin')
+
+
+class ColumnarTable:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != TABLE_VERSION:
+            raise ValueError(f"Unsupported table version {meta.get('version')} in {path}")
+        self.site = meta['site']
+        self.rows = meta['rows']
+        self.equipment = meta['equipment']
+        self.config_bytes = meta['config_bytes']
+        self.columns = dict((name, code) for name, code in meta['columns'])
+        self._maps = {}
+
+    def _map(self, filename, code):
+        # Mapped lazily, and only once per file
+        if filename not in self._maps:
+            with open(os.path.join(self.path, filename), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    self._maps[filename] = memoryview(b'').cast(code)
+                else:
+                    self._maps[filename] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(code)
+        return self._maps[filename]
+
+    def column(self, name):
+        # Zero-copy view of a whole column (config_bytes bytes per row for 'config')
+        length = self.rows * self.config_bytes if name == 'config' else self.rows
+        return self._map(os.path.basename(column_path(self.path, name)), self.columns[name])[:length]
+
+    def column_array(self, name):
+        # Same column as a NumPy array (still zero-copy, one row of bytes per config); requires numpy
+        import numpy
+        values = numpy.frombuffer(self.column(name), dtype=numpy.dtype(self.columns[name]).newbyteorder('<'))
+        return values.reshape(self.rows, self.config_bytes) if name == 'config' else values
+
+    def mask(self, down=()):
+        active = [name for name in self.equipment if name not in down]
+        return sum(1 << self.equipment.index(name) for name in active)
+
+    def config(self, i):
+        width = self.config_bytes
+        return int.from_bytes(self.column('config')[i * width:(i + 1) * width], 'big')
+
+    def find(self, config):
+        # Row number of a configuration, or None
+        width = self.config_bytes
+        key = config.to_bytes(width, 'big')
+        configs = self._map('config.idx', 'B')
+        lo, hi = 0, len(configs) // width
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if configs[mid * width:(mid + 1) * width].tobytes() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(configs) // width and configs[lo * width:(lo + 1) * width].tobytes() == key:
+            return self._map('row.idx', 'Q')[lo]
+        return None
+
+    def row(self, i):
+        return {name: self.config(i) if name == 'config' else self.column(name)[i] for name in self.columns}
+
+    def close(self):
+        for view in self._maps.values():
+            view.release()
+        self._maps = {}
+
+
+def sweep(path, plant=KELANIS_PLANT, max_down=2, max_workers=None):
+    # Solve every outage combination of up to `max_down` units and store the results
+    equipment = plant_equipment(plant)
+    cases = (down for n in range(max_down + 1) for down in itertools.combinations(equipment, n))
+    max_workers = max_workers or os.cpu_count()
+
+    def solve(down):
+        return solve_network_flow([h for h in plant['hoppers'] if h not in down],
+                                  [r for r in plant['reclaimers'] if r not in down],
+                                  [o for o in plant['outloadings'] if o not in down],
+                                  solver=pulp.PULP_CBC_CMD(msg=False), plant=plant)
+
+    # Only a window of cases is in flight, so results never pile up behind the in-order writer
+    writer = ColumnarWriter(path, plant)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        window = collections.deque(executor.submit(solve, down) for down in itertools.islice(cases, 4 * max_workers))
+        while window:
+            solution = window.popleft().result()
+            down = next(cases, None)
+            if down is not None:
+                window.append(executor.submit(solve, down))
+            writer.append(solution)
+    writer.close()
+    return writer.rows
+
+
+def main(argv=None):
+    from kelanis_sites import default_registry
+
+    parser = argparse.ArgumentParser(description="Columnar sweep tables.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sweep_parser = subparsers.add_parser('sweep', help="solve all outage combinations into a table")
+    sweep_parser.add_argument('path')
+    sweep_parser.add_argument('--site', default=KELANIS_PLANT['name'])
+    sweep_parser.add_argument('--max-down', type=int, default=2)
+    lookup_parser = subparsers.add_parser('lookup', help="show the stored result for one outage set")
+    lookup_parser.add_argument('path')
+    lookup_parser.add_argument('--down', default='')
+    summary_parser = subparsers.add_parser('summary', help="row count and status breakdown")
+    summary_parser.add_argument('path')
+    args = parser.parse_args(argv)
+
+    if args.command == 'sweep':
+        rows = sweep(args.path, default_registry().get(args.site), args.max_down)
+        print(f"{rows} rows in {args.path}")
+        return 0
+
+    table = ColumnarTable(args.path)
+    try:
+        if args.command == 'lookup':
+            down = [name for name in args.down.split(',') if name]
+            i = table.find(table.mask(down))
+            if i is None:
+                print("Configuration not in table")
+                return 1
+            for name, value in table.row(i).items():
+                if name == 'status':
+                    value = pulp.LpStatus[value]
+                if name.startswith('edge:') and not value:
+                    continue
+                print(f"{name:<24} {value}")
+        else:
+            counts = {}
+            for code in table.column('status'):
+                counts[code] = counts.get(code, 0) + 1
+            print(f"{table.site}: {table.rows} rows")
+            for code, count in sorted(counts.items()):
+                print(f"  {pulp.LpStatus[code]:<12} {count}")
+    finally:
+        table.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+N-1 / N-2 equipment-failure contingency analysis for the Kelanis network.
+"""
+
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pulp
+
+from kelanis_model import KELANIS_PLANT, solve_network_flow, outloading_tonnage
+
+
+def contingency_cases(active_hoppers, active_reclaimers, active_outloadings, max_failures=2):
+    # Every combination of 1..max_failures active units failing together
+    units = list(active_hoppers) + list(active_reclaimers) + list(active_outloadings)
+    for n in range(1, max_failures + 1):
+        for failed in itertools.combinations(units, n):
+            yield failed
+
+
+def surviving_equipment(active_hoppers, active_reclaimers, active_outloadings, failed):
+    hoppers = [h for h in active_hoppers if h not in failed]
+    reclaimers = [r for r in active_reclaimers if r not in failed]
+    outloadings = [o for o in active_outloadings if o not in failed]
+    return hoppers, reclaimers, outloadings
+
+
+def variant_result(solution):
+    # Outcome of one equipment variant; infeasible variants count as 0 t
+    feasible = solution['status'] == 'Optimal'
+    return {
+        'status': solution['status'],
+        'feasible': feasible,
+        'objective': solution['objective'] if feasible else 0,
+        'tonnage': outloading_tonnage(solution) if feasible else {},
+    }
+
+
+def solve_variant(hoppers, reclaimers, outloadings, warm_start=None, plant=KELANIS_PLANT):
+    # Each CBC run is a subprocess, so threads solve variants in parallel
+    solver = pulp.PULP_CBC_CMD(msg=False, threads=1)
+    return solve_network_flow(hoppers, reclaimers, outloadings, solver=solver, warm_start=warm_start, plant=plant)
+
+
+def solve_variants(configurations, active_hoppers, active_reclaimers, active_outloadings, base_solution=None,
+                   max_workers=None, plant=KELANIS_PLANT, service=None, tag='contingency'):
+    # Solves the base case (unless given) and every (hoppers, reclaimers, outloadings) configuration.
+    # With a SolverService the variants share its worker pool and result cache.
+    # Returns the base solution and a variant_result per configuration, in order.
+    if base_solution is None:
+        if service is not None:
+            base_solution = service.solve(plant['name'], active_hoppers, active_reclaimers, active_outloadings)
+        else:
+            base_solution = solve_network_flow(active_hoppers, active_reclaimers, active_outloadings,
+                                               solver=pulp.PULP_CBC_CMD(msg=False), plant=plant)
+
+    # Warm start every variant from the current solution, but only if it is usable
+    warm_start = base_solution['values'] if base_solution['status'] == 'Optimal' else None
+
+    if service is not None:
+        futures = [service.submit(plant['name'], *configuration, warm_start=warm_start, tag=tag)
+                   for configuration in configurations]
+        solutions = [future.result() for future in futures]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            solutions = list(executor.map(
+                lambda configuration: solve_variant(*configuration, warm_start, plant), configurations))
+    return base_solution, [variant_result(solution) for solution in solutions]
+
+
+def run_contingency_analysis(active_hoppers, active_reclaimers, active_outloadings,
+                             base_solution=None, max_failures=2, max_workers=None, plant=KELANIS_PLANT, service=None):
+    cases = list(contingency_cases(active_hoppers, active_reclaimers, active_outloadings, max_failures))
+    configurations = [surviving_equipment(active_hoppers, active_reclaimers, active_outloadings, failed)
+                      for failed in cases]
+    base_solution, results = solve_variants(configurations, active_hoppers, active_reclaimers, active_outloadings,
+                                            base_solution, max_workers, plant, service, tag='contingency')
+
+    base = variant_result(base_solution)
+    for failed, result in zip(cases, results):
+        result['failed'] = failed
+        result['loss'] = base['objective'] - result['objective']
+        result['outloading_loss'] = {o: t - result['tonnage'].get(o, 0) for o, t in base['tonnage'].items()}
+
+    # Worst contingencies first
+    results.sort(key=lambda r: (r['feasible'], -r['loss']))
+    return base_solution, results
+
+
+def format_base(base_solution):
+    # Report header; the tonnage is only meaningful for an optimal base case
+    if base_solution['status'] != 'Optimal':
+        return f"base status: {base_solution['status']}"
+    return f"base status: {base_solution['status']}, base tonnage: {int(base_solution['objective'])}/hour"
+
+
+def format_contingency_report(base_solution, results):
+    result = f"Contingency Analysis ({format_base(base_solution)})\n"
+    result += "-----" * 30 + "\n"
+
+    for n, title in [(1, "N-1"), (2, "N-2")]:
+        cases = [r for r in results if len(r['failed']) == n]
+        if not cases:
+            continue
+        infeasible = sum(1 for r in cases if not r['feasible'])
+        result += f"\n{title} contingencies: {len(cases)} cases, {infeasible} infeasible\n"
+
+        for i, r in enumerate(cases, 1):
+            failed = " + ".join(r['failed'])
+            if not r['feasible']:
+                result += f"{i}. {failed} | {r['status']}\n"
+                continue
+            changes = ", ".join(f"{o} {-int(loss):+d}" for o, loss in r['outloading_loss'].items() if abs(loss) >= 1)
+            result += f"{i}. {failed} | {int(r['objective'])}/hour | {-int(r['loss']):+d}"
+            result += f" ({changes})\n" if changes else "\n"
+        result += "-----" * 30 + "\n"
+
+    return result
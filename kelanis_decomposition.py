@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+Decomposition by jetty. The rows that couple the jetties are
+    - each hopper is used exactly once
+    - each reclaimer is used at most once
+    - paired reclaimers (L16/L21) may not run on different jetties
+and they only involve shared equipment, i.e. units with routes to more than
+one jetty (H5, H7, L16 and L21 on Kelanis). These rows are relaxed with
+Lagrange multipliers and the per-jetty subproblems are solved in parallel.
+Each round gives an upper bound, a primal heuristic that assigns every shared
+unit to one jetty gives a lower bound, and the multipliers follow a
+subgradient step. When the duality gap does not close and the shared
+equipment is small enough, the remaining gap is closed exactly by enumerating
+the jetty assignments of the shared units. Anything short of a proven answer
+(an open gap, or flows the full model rejects) falls back to the monolithic
+solve, warm-started from the decomposition's incumbent.
+
+Usage:
+    python kelanis_decomposition.py [--site NAME] [--down H3,L17] [--compare]
+"""
+
+import argparse
+import itertools
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pulp
+
+from kelanis_model import KELANIS_PLANT, build_tight_model, finish_solve, snapshot_model, solve_checked, \
+    solve_network_flow
+from kelanis_profiling import profile_stage
+
+
+def jetty_routes(plant, active_hoppers, active_reclaimers, active_outloadings):
+    # unit -> {jetty: [outloadings it can feed there]}, only routes a used unit could take
+    jetty_of = {o: j for j, ol in plant['jetties'].items() for o in ol if o in active_outloadings}
+    target = plant['outloading_target']
+    routes = {}
+    for h in active_hoppers:
+        capacity = plant['hopper_capacity'][h]
+        for o in plant['allowed_flows'][h]:
+            # A used hopper sends at least 90% of capacity, which must fit under 1.7 x target
+            if o in jetty_of and 0.9 * capacity <= 1.7 * target[o]:
+                routes.setdefault(h, {}).setdefault(jetty_of[o], []).append(o)
+    for r in active_reclaimers:
+        for o in plant['allowed_reclaim_flows'][r]:
+            if o in jetty_of:
+                routes.setdefault(r, {}).setdefault(jetty_of[o], []).append(o)
+    return routes
+
+
+def build_jetty_model(j, outloadings, plant, routes, active_hoppers, active_reclaimers, prices=None,
+                      assignment=None):
+    # Subproblem for one jetty. Shared hoppers are optional here and units cost prices[unit, j] when
+    # used. With an assignment, units it places elsewhere (or nowhere) are left out, and assigned
+    # hoppers must be used on this jetty.
+    prices = prices or {}
+    hopper_capacity = plant['hopper_capacity']
+    reclaimer_capacity = plant['reclaimer_capacity']
+    target = plant['outloading_target']
+
+    hoppers = [h for h in active_hoppers if j in routes.get(h, {})]
+    reclaimers = [r for r in active_reclaimers if j in routes.get(r, {})]
+    shared = {u for u in hoppers + reclaimers if len(routes[u]) > 1}
+    if assignment is not None:
+        hoppers = [h for h in hoppers if assignment.get(h, j) == j]
+        reclaimers = [r for r in reclaimers if assignment.get(r, j) == j]
+
+    prob = pulp.LpProblem(f"Jetty_{j}", pulp.LpMaximize)
+    hopper_keys = [(h, o) for h in hoppers for o in routes[h][j]]
+    reclaimer_keys = [(r, o) for r in reclaimers for o in routes[r][j]]
+    flow = {(h, o): pulp.LpVariable(f"flow_{h}_{o}", 0, min(hopper_capacity[h], 1.7 * target[o]))
+            for h, o in hopper_keys}
+    reclaim_flow = {(r, o): pulp.LpVariable(f"reclaim_flow_{r}_{o}", 0, min(reclaimer_capacity[r], 1.7 * target[o]))
+                    for r, o in reclaimer_keys}
+    hopper_use = {key: pulp.LpVariable(f"hopper_use_{key[0]}_{key[1]}", cat='Binary') for key in hopper_keys}
+    reclaimer_use = {key: pulp.LpVariable(f"reclaimer_use_{key[0]}_{key[1]}", cat='Binary') for key in reclaimer_keys}
+    used = {u: pulp.lpSum(hopper_use[u, o] for o in routes[u][j]) for u in hoppers}
+    used.update({u: pulp.lpSum(reclaimer_use[u, o] for o in routes[u][j]) for u in reclaimers})
+
+    prob += pulp.lpSum(flow.values()) + pulp.lpSum(reclaim_flow.values()) - \
+        pulp.lpSum(prices[u, j] * used[u] for u in used if prices.get((u, j)))
+
+    for h in hoppers:
+        # Hoppers without another jetty (or assigned here) are used exactly once on this jetty
+        if h not in shared or assignment is not None:
+            prob += used[h] == 1
+        else:
+            prob += used[h] <= 1
+        for o in routes[h][j]:
+            prob += flow[h, o] >= 0.9 * hopper_capacity[h] * hopper_use[h, o]
+            prob += flow[h, o] <= flow[h, o].upBound * hopper_use[h, o]
+    for r in reclaimers:
+        prob += used[r] <= 1
+        for o in routes[r][j]:
+            prob += reclaim_flow[r, o] <= reclaim_flow[r, o].upBound * reclaimer_use[r, o]
+
+    for o in outloadings:
+        total = pulp.lpSum(f for (u, p), f in flow.items() if p == o) + \
+                pulp.lpSum(f for (u, p), f in reclaim_flow.items() if p == o)
+        prob += total >= 0.8 * target[o]
+        prob += total <= 1.7 * target[o]
+
+    for eh, er, eo in plant['exclusive_pairs']:
+        if (eh, eo) in hopper_use and (er, eo) in reclaimer_use:
+            prob += hopper_use[eh, eo] + reclaimer_use[er, eo] <= 1
+
+    # Paired reclaimers on this jetty; running on different jetties is a coupling row
+    for ra, rb, _ in plant['paired_reclaimers']:
+        if ra in reclaimers and rb in reclaimers:
+            for o in routes[ra][j]:
+                prob += reclaimer_use[ra, o] + pulp.lpSum(reclaimer_use[rb, p] for p in routes[rb][j] if p != o) <= 1
+
+    if j in plant['jetty_share']:
+        hopper_min, hopper_max, reclaimer_min, reclaimer_max = plant['jetty_share'][j]
+        target_j = sum(target[o] for o in outloadings)
+        prob += pulp.lpSum(flow.values()) >= hopper_min * target_j
+        prob += pulp.lpSum(flow.values()) <= hopper_max * target_j
+        prob += pulp.lpSum(reclaim_flow.values()) >= reclaimer_min * target_j
+        prob += pulp.lpSum(reclaim_flow.values()) <= reclaimer_max * target_j
+
+    return prob, {'flow': flow, 'reclaim_flow': reclaim_flow, 'used': used}
+
+
+def solve_jetty(j, outloadings, plant, routes, active_hoppers, active_reclaimers, prices=None, assignment=None):
+    prob, variables = build_jetty_model(j, outloadings, plant, routes, active_hoppers, active_reclaimers,
+                                        prices, assignment)
+    solve_checked(prob, pulp.PULP_CBC_CMD(msg=False))
+    if prob.status != pulp.LpStatusOptimal:
+        return {'jetty': j, 'feasible': False}
+
+    flows = {key: var.value() or 0 for key, var in variables['flow'].items()}
+    flows.update({key: var.value() or 0 for key, var in variables['reclaim_flow'].items()})
+    return {
+        'jetty': j,
+        'feasible': True,
+        'objective': pulp.value(prob.objective) or 0,
+        'tonnage': sum(flows.values()),
+        'flows': flows,
+        'used': {u for u, expression in variables['used'].items() if round(pulp.value(expression) or 0)},
+    }
+
+
+class JettyDecomposition:
+    def __init__(self, active_hoppers, active_reclaimers, active_outloadings, plant=KELANIS_PLANT, max_workers=None):
+        self.plant = plant
+        self.active_hoppers = list(active_hoppers)
+        self.active_reclaimers = list(active_reclaimers)
+        self.active_outloadings = list(active_outloadings)
+        self.jetties = {j: [o for o in ol if o in active_outloadings] for j, ol in plant['jetties'].items()}
+        self.jetties = {j: ol for j, ol in self.jetties.items() if ol}
+        self.routes = jetty_routes(plant, active_hoppers, active_reclaimers, active_outloadings)
+        self.shared_hoppers = [h for h in self.active_hoppers if len(self.routes.get(h, {})) > 1]
+        self.shared_reclaimers = [r for r in self.active_reclaimers if len(self.routes.get(r, {})) > 1]
+        # Paired reclaimers that could end up on different jetties
+        self.cross_pairs = [(ra, rb, ja, jb) for ra, rb, _ in plant['paired_reclaimers']
+                            if ra in self.routes and rb in self.routes
+                            for ja in self.routes[ra] for jb in self.routes[rb] if ja != jb]
+        # Units whose jetty the coordination decides
+        self.placed = self.shared_hoppers + self.shared_reclaimers
+        self.placed += [r for ra, rb, _, _ in self.cross_pairs for r in (ra, rb) if r not in self.placed]
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or min(len(self.jetties), os.cpu_count() or 1) or 1)
+        self._fixed_cache = {}
+
+    def solve_all(self, prices=None, assignment=None):
+        futures = [self.executor.submit(solve_jetty, j, ol, self.plant, self.routes, self.active_hoppers,
+                                        self.active_reclaimers, prices, assignment)
+                   for j, ol in self.jetties.items()]
+        return [future.result() for future in futures]
+
+    def prices(self, multipliers):
+        prices = {}
+        for u in self.shared_hoppers + self.shared_reclaimers:
+            for j in self.routes[u]:
+                prices[u, j] = multipliers[u]
+        for pair in self.cross_pairs:
+            ra, rb, ja, jb = pair
+            prices[ra, ja] = prices.get((ra, ja), 0) + multipliers[pair]
+            prices[rb, jb] = prices.get((rb, jb), 0) + multipliers[pair]
+        return prices
+
+    def subgradient(self, subproblems):
+        used = {(u, s['jetty']) for s in subproblems for u in s['used']}
+        g = {}
+        for u in self.shared_hoppers + self.shared_reclaimers:
+            g[u] = 1 - sum((u, j) in used for j in self.routes[u])
+        for pair in self.cross_pairs:
+            ra, rb, ja, jb = pair
+            g[pair] = 1 - ((ra, ja) in used) - ((rb, jb) in used)
+        return g
+
+    def repair(self, subproblems, fallback=None):
+        # Turn the subproblem choices into one jetty per placed unit
+        tonnage = {}
+        for s in subproblems:
+            for (u, o), f in s['flows'].items():
+                tonnage[u, s['jetty']] = tonnage.get((u, s['jetty']), 0) + f
+        assignment = {}
+        for u in self.placed:
+            best = max(self.routes[u], key=lambda j: tonnage.get((u, j), 0))
+            if not tonnage.get((u, best), 0) and fallback:
+                assignment[u] = fallback[u]
+            else:
+                assignment[u] = best
+        for ra, rb, _, _ in self.cross_pairs:
+            if None not in (assignment[ra], assignment[rb]) and assignment[ra] != assignment[rb]:
+                # Keep the busier of the pair; the other follows it or stays idle
+                keep, move = (ra, rb) if tonnage.get((ra, assignment[ra]), 0) >= \
+                    tonnage.get((rb, assignment[rb]), 0) else (rb, ra)
+                assignment[move] = assignment[keep] if assignment[keep] in self.routes[move] else None
+        return assignment
+
+    def solve_assignment(self, assignment):
+        # With every placed unit fixed the jetties are independent; results are cached per jetty
+        keys = [(j, frozenset(u for u, a in assignment.items() if a == j)) for j in self.jetties]
+        for key in keys:
+            if key not in self._fixed_cache:
+                self._fixed_cache[key] = self.executor.submit(solve_jetty, key[0], self.jetties[key[0]], self.plant,
+                                                              self.routes, self.active_hoppers,
+                                                              self.active_reclaimers, None, assignment)
+        results = [self._fixed_cache[key].result() for key in keys]
+        return results if all(s['feasible'] for s in results) else None
+
+    def assignments(self):
+        # Every placement of the placed units. Hoppers go to one of their jetties; reclaimers may
+        # also be left idle, which only matters when their pair partner runs where they cannot.
+        partner = {}
+        for ra, rb, _, _ in self.cross_pairs:
+            partner[ra], partner[rb] = rb, ra
+        options = [list(self.routes[u]) + ([None] if u in partner else []) for u in self.placed]
+        for choice in itertools.product(*options):
+            assignment = dict(zip(self.placed, choice))
+            valid = True
+            for u, v in partner.items():
+                if assignment[u] is None:
+                    valid = valid and assignment[v] is not None and assignment[v] not in self.routes[u]
+                elif assignment[v] is not None:
+                    valid = valid and assignment[u] == assignment[v]
+            if valid:
+                yield assignment
+
+    def combinations(self):
+        count = 1
+        for u in self.placed:
+            count *= len(self.routes[u]) + 1
+        return count
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def solve_decomposed(active_hoppers, active_reclaimers, active_outloadings, plant=KELANIS_PLANT, max_iterations=30,
+                     tolerance=1e-4, exact_limit=256, max_workers=None):
+    start = time.perf_counter()
+    d = JettyDecomposition(active_hoppers, active_reclaimers, active_outloadings, plant, max_workers)
+    try:
+        with profile_stage('solve'):
+            upper, lower, best, iterations, method = _solve(d, max_iterations, tolerance, exact_limit)
+    finally:
+        d.shutdown()
+
+    # Assemble the jetty solutions into the monolithic model, which also checks them.
+    # A recorded bundle holds that model, so replaying it re-solves the full problem.
+    with profile_stage('build_model'):
+        prob, active_jetties, variables = build_tight_model(active_hoppers, active_reclaimers, active_outloadings,
+                                                            plant, symmetry_breaking=False)
+    model_dict = snapshot_model(prob)
+    if best is not None:
+        values = {}
+        for s in best:
+            for (u, o), f in s['flows'].items():
+                values[u, s['jetty'], o] = f
+        for (h, j, o), var in variables['flow'].items():
+            var.varValue = values.get((h, j, o), 0)
+            variables['hopper_use'][h, o].varValue = 1 if values.get((h, j, o), 0) > 1e-6 else 0
+        for (r, j, o), var in variables['reclaim_flow'].items():
+            var.varValue = values.get((r, j, o), 0)
+            variables['reclaimer_use'][r, o].varValue = 1 if values.get((r, j, o), 0) > 1e-6 else 0
+        valid = prob.valid(eps=1e-4)
+        if not valid:
+            logging.warning("Decomposed solution violates the monolithic model")
+        closed = upper - lower <= tolerance * max(abs(upper), 1)
+        prob.assignStatus(pulp.LpStatusOptimal if valid else pulp.LpStatusNotSolved,
+                          pulp.LpSolutionOptimal if closed else pulp.LpSolutionIntegerFeasible)
+    elif method == 'infeasible':
+        prob.assignStatus(pulp.LpStatusInfeasible)
+    else:
+        prob.assignStatus(pulp.LpStatusNotSolved)
+
+    proven = method == 'infeasible' or (prob.status == pulp.LpStatusOptimal and
+                                        prob.sol_status == pulp.LpSolutionOptimal)
+    # Unproven results are not recorded; the fallback solve records its own bundle
+    solution = finish_solve(prob, active_hoppers, active_reclaimers, active_outloadings, active_jetties, variables,
+                            plant, pulp.PULP_CBC_CMD(msg=False), time.perf_counter() - start,
+                            model_dict if proven else None)
+    solution['bound'] = upper
+    solution['gap'] = (upper - lower) / max(abs(upper), 1) if best is not None else None
+    solution['iterations'] = iterations
+    solution['method'] = method
+    if proven:
+        return solution
+
+    # Not proven: an open gap must not be passed on (and cached) as an optimum
+    logging.warning(f"Decomposition did not prove optimality (gap {solution['gap']}), solving the full model")
+    warm_start = solution['values'] if prob.status == pulp.LpStatusOptimal else None
+    fallback = solve_network_flow(active_hoppers, active_reclaimers, active_outloadings,
+                                  solver=pulp.PULP_CBC_CMD(msg=False), warm_start=warm_start, plant=plant)
+    fallback['solve_time'] = time.perf_counter() - start
+    fallback['bound'] = fallback['objective'] if fallback['status'] == 'Optimal' else upper
+    fallback['gap'] = 0.0 if fallback['status'] == 'Optimal' else None
+    fallback['decomposition_gap'] = solution['gap']
+    fallback['iterations'] = iterations
+    fallback['method'] = 'fallback'
+    return fallback
+
+
+def _solve(d, max_iterations, tolerance, exact_limit):
+    # Units with no usable route at all make "used exactly once" impossible
+    if any(h not in d.routes for h in d.active_hoppers):
+        return float('-inf'), float('-inf'), None, 0, 'infeasible'
+
+    multipliers = {u: 0.0 for u in d.shared_hoppers + d.shared_reclaimers}
+    multipliers.update({pair: 0.0 for pair in d.cross_pairs})
+    upper, lower, best, assignment = float('inf'), float('-inf'), None, None
+    theta, stalled = 2.0, 0
+
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        subproblems = d.solve_all(d.prices(multipliers))
+        # The subproblems relax the plant, so one infeasible jetty makes the whole plant infeasible
+        if not all(s['feasible'] for s in subproblems):
+            return float('-inf'), float('-inf'), None, iteration, 'infeasible'
+
+        value = sum(s['objective'] for s in subproblems) + sum(multipliers.values())
+        if value < upper - 1e-6:
+            upper, stalled = value, 0
+        else:
+            stalled += 1
+            if stalled >= 3:
+                theta, stalled = theta / 2, 0
+
+        assignment = d.repair(subproblems, assignment)
+        fixed = d.solve_assignment(assignment)
+        if fixed is not None:
+            tonnage = sum(s['tonnage'] for s in fixed)
+            if tonnage > lower:
+                lower, best = tonnage, fixed
+
+        if upper - lower <= tolerance * max(abs(upper), 1):
+            return upper, lower, best, iteration, 'lagrangian'
+
+        g = d.subgradient(subproblems)
+        norm = sum(x * x for x in g.values())
+        if norm == 0:
+            break
+        # Polyak step towards the best known primal value
+        target = lower if best is not None else 0.95 * upper
+        step = theta * (value - target) / norm
+        for key, gk in g.items():
+            multipliers[key] -= step * gk
+            if key not in d.shared_hoppers:
+                # Inequality rows keep non-negative multipliers
+                multipliers[key] = max(0.0, multipliers[key])
+
+    # Close the remaining gap by trying every placement of the shared units
+    if d.combinations() > exact_limit:
+        return upper, lower, best, iteration, 'lagrangian'
+
+    for assignment in d.assignments():
+        fixed = d.solve_assignment(assignment)
+        if fixed is not None:
+            tonnage = sum(s['tonnage'] for s in fixed)
+            if tonnage > lower:
+                lower, best = tonnage, fixed
+    if best is None:
+        return float('-inf'), float('-inf'), None, iteration, 'infeasible'
+    return lower, lower, best, iteration, 'enumeration'
+
+
+def main(argv=None):
+    from kelanis_model import solve_network_flow
+    from kelanis_sites import default_registry
+
+    parser = argparse.ArgumentParser(description="Solve one scenario by jetty decomposition.")
+    parser.add_argument('--site', default=KELANIS_PLANT['name'])
+    parser.add_argument('--down', default='', help="comma-separated equipment that is out of service")
+    parser.add_argument('--max-iterations', type=int, default=30)
+    parser.add_argument('--compare', action='store_true', help="also solve the monolithic model")
+    args = parser.parse_args(argv)
+
+    plant = default_registry().get(args.site)
+    down = {name for name in args.down.split(',') if name}
+    active = ([h for h in plant['hoppers'] if h not in down],
+              [r for r in plant['reclaimers'] if r not in down],
+              [o for o in plant['outloadings'] if o not in down])
+    solution = solve_decomposed(*active, plant=plant, max_iterations=args.max_iterations)
+    gap = f"{solution['gap']:.4%}" if solution['gap'] is not None else "-"
+    print(f"decomposed:  {solution['status']:<12} {solution['objective']:>10.0f}/hour  bound {solution['bound']:.0f}  "
+          f"gap {gap}  {solution['iterations']} iterations, {solution['method']}, {solution['solve_time']:.3f}s")
+    if args.compare:
+        monolithic = solve_network_flow(*active, solver=pulp.PULP_CBC_CMD(msg=False), plant=plant)
+        print(f"monolithic:  {monolithic['status']:<12} {monolithic['objective']:>10.0f}/hour  "
+              f"{monolithic['solve_time']:.3f}s")
+        if monolithic['status'] != solution['status'] or \
+                (monolithic['status'] == 'Optimal' and abs(monolithic['objective'] - solution['objective']) > 1e-3):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,557 @@
+# -*- coding: utf-8 -*-
+"""
+Distributed outage sweeps. A coordinator splits the outage combinations of a
+site into work units; workers on other machines (or extra local processes)
+pull units, solve them and push the results back. The coordinator merges the
+results, in scenario order, into one columnar table (kelanis_columnar).
+
+Units are leased: a worker sends heartbeats while it solves, and a unit whose
+lease runs out goes back to the queue for another worker. The lease timeout
+and attempt limit are the coordinator's; workers learn them from the queue
+(queue.json in a directory queue, the pull response over TCP). Results are keyed
+by unit, so a unit finished twice is only stored once. A unit that fails or
+expires `max_attempts` times is given up and reported.
+
+Queues are selected with a spec string:
+    tcp:0.0.0.0:5600       coordinator serves newline-delimited JSON over TCP
+    dir:S:/sweeps/run1     shared directory; units are claimed by renaming files
+
+Usage:
+    python kelanis_distributed.py coordinator --queue tcp:0.0.0.0:5600 --output TABLE_DIR [--max-down 2]
+                                              [--unit-size 50] [--local-workers 2]
+    python kelanis_distributed.py worker --queue tcp:coordinator-pc:5600
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import pulp
+
+from kelanis_columnar import ColumnarWriter
+from kelanis_contingency import contingency_cases, surviving_equipment
+from kelanis_history import plant_hash
+from kelanis_model import KELANIS_PLANT, solve_network_flow
+
+DEFAULT_QUEUE_SETTINGS = {'lease_timeout': 60, 'max_attempts': 3}
+
+
+def scenario_cases(plant, max_down):
+    # No outage first, then every combination of up to `max_down` units, in a fixed order
+    return itertools.chain([()], contingency_cases(plant['hoppers'], plant['reclaimers'], plant['outloadings'],
+                                                   max_down))
+
+
+def make_units(plant, max_down, unit_size):
+    # Units only carry a slice of the case order; workers enumerate the cases themselves
+    total = sum(1 for _ in scenario_cases(plant, max_down))
+    hash_ = plant_hash(plant)
+    return [{'id': i, 'site': plant['name'], 'plant_hash': hash_, 'max_down': max_down,
+             'start': start, 'stop': min(start + unit_size, total)}
+            for i, start in enumerate(range(0, total, unit_size))]
+
+
+def scenario_record(down, solution):
+    return {
+        'down': list(down),
+        'status': solution['status'],
+        'objective': solution['objective'],
+        'flow': [[*key, f] for key, f in solution['flow'].items() if f],
+        'reclaim_flow': [[*key, f] for key, f in solution['reclaim_flow'].items() if f],
+    }
+
+
+def record_solution(plant, record):
+    # Enough of a solution dict for ColumnarWriter.append
+    hoppers, reclaimers, outloadings = surviving_equipment(plant['hoppers'], plant['reclaimers'],
+                                                           plant['outloadings'], record['down'])
+    return {
+        'status': record['status'],
+        'objective': record['objective'],
+        'active_hoppers': hoppers,
+        'active_reclaimers': reclaimers,
+        'active_outloadings': outloadings,
+        'flow': {(h, j, o): f for h, j, o, f in record['flow']},
+        'reclaim_flow': {(r, j, o): f for r, j, o, f in record['reclaim_flow']},
+    }
+
+
+class WorkCoordinator:
+    # In-memory queue state; served to workers by serve_tcp()
+
+    def __init__(self, units, lease_timeout=60, max_attempts=3):
+        self.units = {unit['id']: unit for unit in units}
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.pending = collections.deque(sorted(self.units))
+        self.leases = {}
+        self.attempts = collections.Counter()
+        self.completed = set()
+        # Results wait here until the merge takes them
+        self.results = {}
+        self.failed = {}
+        self._lock = threading.Lock()
+
+    def pull(self, worker):
+        with self._lock:
+            self._reclaim_expired()
+            if self.pending:
+                unit_id = self.pending.popleft()
+                self.attempts[unit_id] += 1
+                self.leases[unit_id] = (worker, time.monotonic() + self.lease_timeout)
+                return {'unit': self.units[unit_id], 'lease_timeout': self.lease_timeout,
+                        'max_attempts': self.max_attempts}
+            if len(self.completed) + len(self.failed) == len(self.units):
+                return {'done': True}
+            # Everything left is leased; ask again in case a lease expires
+            return {'wait': min(5, self.lease_timeout)}
+
+    def heartbeat(self, worker, unit_id):
+        with self._lock:
+            lease = self.leases.get(unit_id)
+            if lease is None or lease[0] != worker:
+                return {'ok': False}
+            self.leases[unit_id] = (worker, time.monotonic() + self.lease_timeout)
+            return {'ok': True}
+
+    def complete(self, worker, unit_id, records):
+        with self._lock:
+            # First result wins; a late duplicate from a reassigned unit is dropped
+            if unit_id in self.completed or unit_id in self.failed:
+                return {'accepted': False}
+            self.completed.add(unit_id)
+            self.results[unit_id] = records
+            self.leases.pop(unit_id, None)
+            if unit_id in self.pending:
+                self.pending.remove(unit_id)
+            return {'accepted': True}
+
+    def fail(self, worker, unit_id, error):
+        with self._lock:
+            if self.leases.get(unit_id, (None,))[0] == worker:
+                del self.leases[unit_id]
+                self._retry(unit_id, f"{worker}: {error}")
+            return {'ok': True}
+
+    def reclaim_expired(self):
+        with self._lock:
+            self._reclaim_expired()
+
+    def _reclaim_expired(self):
+        now = time.monotonic()
+        for unit_id, (worker, deadline) in list(self.leases.items()):
+            if deadline < now:
+                logging.warning(f"Unit {unit_id} lease expired on {worker}, reassigning")
+                del self.leases[unit_id]
+                self._retry(unit_id, f"{worker}: lease expired")
+
+    def _retry(self, unit_id, error):
+        if self.attempts[unit_id] >= self.max_attempts:
+            logging.error(f"Giving up on unit {unit_id} after {self.attempts[unit_id]} attempts: {error}")
+            self.failed[unit_id] = error
+        else:
+            self.pending.append(unit_id)
+
+    def outcome(self, unit_id):
+        # ('done', records), ('failed', error) or None while the unit is outstanding
+        with self._lock:
+            if unit_id in self.results:
+                return 'done', self.results.pop(unit_id)
+            if unit_id in self.failed:
+                return 'failed', self.failed[unit_id]
+            return None
+
+
+class _QueueHandler(socketserver.StreamRequestHandler):
+    OPS = {'pull', 'heartbeat', 'complete', 'fail'}
+
+    def handle(self):
+        line = self.rfile.readline().decode('utf-8').strip()
+        try:
+            request = json.loads(line)
+            op = request.pop('op')
+            if op not in self.OPS:
+                raise ValueError(f"Unknown operation {op!r}")
+            response = getattr(self.server.coordinator, op)(**request)
+        except (ValueError, TypeError, KeyError) as e:
+            response = {'error': str(e)}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b"\n")
+
+
+def serve_tcp(coordinator, host, port):
+    # Returns the running server; its server_address holds the real port when 0 was asked for
+    server = socketserver.ThreadingTCPServer((host, port), _QueueHandler)
+    server.daemon_threads = True
+    server.coordinator = coordinator
+    threading.Thread(target=server.serve_forever, name='WorkCoordinator', daemon=True).start()
+    return server
+
+
+class TcpWorkQueue:
+    # Worker side of serve_tcp(); one short connection per request
+
+    def __init__(self, host, port, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def _request(self, op, **kwargs):
+        with socket.create_connection((self.host, self.port), timeout=self.timeout) as connection:
+            connection.sendall(json.dumps({'op': op, **kwargs}).encode('utf-8') + b"\n")
+            response = json.loads(connection.makefile('rb').readline().decode('utf-8'))
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    def pull(self, worker):
+        return self._request('pull', worker=worker)
+
+    def heartbeat(self, worker, unit_id):
+        return self._request('heartbeat', worker=worker, unit_id=unit_id)
+
+    def complete(self, worker, unit_id, records):
+        return self._request('complete', worker=worker, unit_id=unit_id, records=records)
+
+    def fail(self, worker, unit_id, error):
+        return self._request('fail', worker=worker, unit_id=unit_id, error=error)
+
+
+class DirectoryWorkQueue:
+    # Queue kept as files in a shared directory, usable by workers and the coordinator:
+    #   pending/<unit>.json             waiting to be claimed
+    #   leased/<unit>--<worker>.json    claimed by an atomic rename; mtime is the heartbeat
+    #   results/<unit>.json             written once, by whichever worker finishes first
+    #   failed/<unit>.json              given up after max_attempts
+    #   queue.json                      unit count and the coordinator's lease_timeout / max_attempts
+
+    def __init__(self, path, lease_timeout=None, max_attempts=None):
+        # Workers leave the settings out and use the ones the coordinator published
+        self.path = path
+        self._settings = {'lease_timeout': lease_timeout, 'max_attempts': max_attempts}
+
+    @property
+    def lease_timeout(self):
+        return self._setting('lease_timeout')
+
+    @property
+    def max_attempts(self):
+        return self._setting('max_attempts')
+
+    def _setting(self, name):
+        value = self._settings[name]
+        if value is None:
+            value = self._read(os.path.join(self.path, 'queue.json')).get(name, DEFAULT_QUEUE_SETTINGS[name])
+        return value
+
+    def _dir(self, name):
+        return os.path.join(self.path, name)
+
+    def _write(self, path, data):
+        # Readers never see a half-written file
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def _read(self, path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _units_in(self, name):
+        # Unit ids with a file in one of the queue directories; _write's *.tmp files are not units
+        return {int(filename[:8]) for filename in os.listdir(self._dir(name)) if filename.endswith('.json')}
+
+    def publish(self, units):
+        # Safe to call again when a coordinator restarts: known units are left alone
+        for name in ('pending', 'leased', 'results', 'failed'):
+            os.makedirs(self._dir(name), exist_ok=True)
+        self._write(os.path.join(self.path, 'queue.json'), {'units': len(units), 'lease_timeout': self.lease_timeout,
+                                                            'max_attempts': self.max_attempts})
+        # One listing per directory, not one per unit: these may be on a slow shared drive
+        known = set()
+        for name in ('pending', 'leased', 'results', 'failed'):
+            known |= self._units_in(name)
+        for unit in units:
+            if unit['id'] not in known:
+                self._write(os.path.join(self._dir('pending'), f"{unit['id']:08d}.json"), {'unit': unit, 'attempts': 0})
+
+    def pull(self, worker):
+        for name in sorted(os.listdir(self._dir('pending'))):
+            if not name.endswith('.json'):
+                continue
+            leased = os.path.join(self._dir('leased'), f"{name[:-5]}--{worker}.json")
+            try:
+                os.rename(os.path.join(self._dir('pending'), name), leased)
+            except OSError:
+                # Another worker claimed it first
+                continue
+            os.utime(leased)
+            return {'unit': self._read(leased)['unit'], 'lease_timeout': self.lease_timeout,
+                    'max_attempts': self.max_attempts}
+        total = self._read(os.path.join(self.path, 'queue.json'))['units']
+        settled = len(self._units_in('results')) + len(self._units_in('failed'))
+        if settled >= total:
+            return {'done': True}
+        return {'wait': min(5, self.lease_timeout)}
+
+    def heartbeat(self, worker, unit_id):
+        try:
+            os.utime(os.path.join(self._dir('leased'), f"{unit_id:08d}--{worker}.json"))
+            return {'ok': True}
+        except OSError:
+            return {'ok': False}
+
+    def complete(self, worker, unit_id, records):
+        result = os.path.join(self._dir('results'), f"{unit_id:08d}.json")
+        accepted = not os.path.exists(result)
+        if accepted:
+            self._write(result, records)
+        try:
+            os.remove(os.path.join(self._dir('leased'), f"{unit_id:08d}--{worker}.json"))
+        except OSError:
+            pass
+        return {'accepted': accepted}
+
+    def fail(self, worker, unit_id, error):
+        leased = os.path.join(self._dir('leased'), f"{unit_id:08d}--{worker}.json")
+        try:
+            self._release(leased, unit_id, f"{worker}: {error}")
+        except OSError:
+            pass
+        return {'ok': True}
+
+    def _release(self, leased, unit_id, error):
+        entry = self._read(leased)
+        entry['attempts'] += 1
+        if entry['attempts'] >= self.max_attempts:
+            logging.error(f"Giving up on unit {unit_id} after {entry['attempts']} attempts: {error}")
+            entry['error'] = error
+            self._write(os.path.join(self._dir('failed'), f"{unit_id:08d}.json"), entry)
+        else:
+            self._write(os.path.join(self._dir('pending'), f"{unit_id:08d}.json"), entry)
+        os.remove(leased)
+
+    def reclaim_expired(self):
+        now = time.time()
+        for name in os.listdir(self._dir('leased')):
+            leased = os.path.join(self._dir('leased'), name)
+            unit_id = int(name.split('--', 1)[0])
+            try:
+                if os.path.exists(os.path.join(self._dir('results'), f"{unit_id:08d}.json")):
+                    # Finished by another worker after being reassigned
+                    os.remove(leased)
+                elif os.stat(leased).st_mtime < now - self.lease_timeout:
+                    logging.warning(f"Unit {unit_id} lease expired on {name[:-5].split('--', 1)[1]}, reassigning")
+                    self._release(leased, unit_id, "lease expired")
+            except OSError:
+                # Completed or released while we looked
+                continue
+
+    def outcome(self, unit_id):
+        try:
+            return 'done', self._read(os.path.join(self._dir('results'), f"{unit_id:08d}.json"))
+        except FileNotFoundError:
+            pass
+        try:
+            return 'failed', self._read(os.path.join(self._dir('failed'), f"{unit_id:08d}.json"))['error']
+        except FileNotFoundError:
+            return None
+
+
+def open_queue(spec, lease_timeout=None, max_attempts=None):
+    scheme, _, arg = spec.partition(':')
+    if scheme == 'tcp':
+        host, port = arg.rsplit(':', 1)
+        return TcpWorkQueue(host or '127.0.0.1', int(port))
+    if scheme == 'dir':
+        return DirectoryWorkQueue(arg, lease_timeout, max_attempts)
+    raise ValueError(f"Unknown work queue type {scheme!r}")
+
+
+def solve_unit(unit, plant):
+    if plant_hash(plant) != unit['plant_hash']:
+        raise ValueError(f"Plant definition of {unit['site']} differs from the coordinator's")
+
+    records = []
+    warm_start = None
+    cases = itertools.islice(scenario_cases(plant, unit['max_down']), unit['start'], unit['stop'])
+    for down in cases:
+        hoppers, reclaimers, outloadings = surviving_equipment(plant['hoppers'], plant['reclaimers'],
+                                                               plant['outloadings'], down)
+        # Neighbouring cases differ by one unit, so each solve seeds the next
+        solution = solve_network_flow(hoppers, reclaimers, outloadings, solver=pulp.PULP_CBC_CMD(msg=False),
+                                      warm_start=warm_start, plant=plant)
+        if solution['status'] == 'Optimal':
+            warm_start = solution['values']
+        records.append(scenario_record(down, solution))
+    return records
+
+
+def run_worker(queue, worker=None, registry=None, heartbeat_interval=None, retry_interval=5, max_retries=12):
+    from kelanis_sites import default_registry
+
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    registry = registry or default_registry()
+    solved = 0
+    retries = 0
+    while True:
+        try:
+            response = queue.pull(worker)
+            retries = 0
+        except OSError as e:
+            # Coordinator restarting or network blip: keep trying for a while
+            retries += 1
+            if retries > max_retries:
+                logging.error(f"Worker {worker} lost the coordinator: {e}")
+                return solved
+            time.sleep(retry_interval)
+            continue
+
+        if response.get('done'):
+            return solved
+        if 'wait' in response:
+            time.sleep(response['wait'])
+            continue
+
+        unit = response['unit']
+        stop = threading.Event()
+        # Several heartbeats per lease, so one lost beat does not cost the unit
+        interval = heartbeat_interval or response.get('lease_timeout', DEFAULT_QUEUE_SETTINGS['lease_timeout']) / 3
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    queue.heartbeat(worker, unit['id'])
+                except OSError:
+                    pass
+
+        beater = threading.Thread(target=beat, name='Heartbeat', daemon=True)
+        beater.start()
+        try:
+            records = solve_unit(unit, registry.get(unit['site']))
+        except Exception as e:
+            logging.error(f"Worker {worker} failed unit {unit['id']}: {e}")
+            stop.set()
+            try:
+                queue.fail(worker, unit['id'], str(e))
+            except OSError:
+                pass
+            continue
+        finally:
+            stop.set()
+            beater.join()
+
+        try:
+            queue.complete(worker, unit['id'], records)
+            solved += len(records)
+        except OSError as e:
+            # The lease will expire and the unit will be solved again
+            logging.error(f"Worker {worker} could not return unit {unit['id']}: {e}")
+
+
+def merge_results(queue, units, plant, output, poll_interval=1.0, progress=None):
+    # Appends unit results to one table in unit order, as soon as each next unit is in
+    writer = ColumnarWriter(output, plant)
+    failed = []
+    for unit in units:
+        while True:
+            queue.reclaim_expired()
+            outcome = queue.outcome(unit['id'])
+            if outcome is not None:
+                break
+            time.sleep(poll_interval)
+        state, value = outcome
+        if state == 'failed':
+            failed.append((unit, value))
+        else:
+            for record in value:
+                writer.append(record_solution(plant, record))
+        if progress is not None:
+            progress(unit, state)
+    writer.close()
+    return writer.rows, failed
+
+
+def run_coordinator(spec, plant, output, max_down=2, unit_size=50, lease_timeout=60, max_attempts=3,
+                    local_workers=0):
+    # A crashed coordinator can leave column files without meta.json; appending to them would misalign rows
+    if os.path.isdir(output) and os.listdir(output):
+        raise ValueError(f"{output} is not empty")
+    units = make_units(plant, max_down, unit_size)
+
+    scheme, _, arg = spec.partition(':')
+    server = None
+    if scheme == 'tcp':
+        queue = WorkCoordinator(units, lease_timeout, max_attempts)
+        host, port = arg.rsplit(':', 1)
+        server = serve_tcp(queue, host or '0.0.0.0', int(port))
+        worker_spec = f"tcp:127.0.0.1:{server.server_address[1]}"
+        logging.info(f"Coordinator listening on port {server.server_address[1]}")
+    elif scheme == 'dir':
+        queue = DirectoryWorkQueue(arg, lease_timeout, max_attempts)
+        queue.publish(units)
+        worker_spec = spec
+    else:
+        raise ValueError(f"Unknown work queue type {scheme!r}")
+
+    # Extra local processes, mostly for testing on one machine
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', '--queue', worker_spec])
+                 for _ in range(local_workers)]
+    try:
+        return merge_results(queue, units, plant, output,
+                             progress=lambda unit, state: logging.info(f"Unit {unit['id']}/{len(units)}: {state}"))
+    finally:
+        for process in processes:
+            process.wait()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+def main(argv=None):
+    from kelanis_sites import default_registry
+
+    parser = argparse.ArgumentParser(description="Distributed outage sweeps.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    coordinator_parser = subparsers.add_parser('coordinator', help="shard the sweep and merge the results")
+    coordinator_parser.add_argument('--queue', required=True, help="tcp:HOST:PORT or dir:PATH")
+    coordinator_parser.add_argument('--output', required=True, help="columnar table directory to create")
+    coordinator_parser.add_argument('--site', default=KELANIS_PLANT['name'])
+    coordinator_parser.add_argument('--max-down', type=int, default=2)
+    coordinator_parser.add_argument('--unit-size', type=int, default=50, help="scenarios per work unit")
+    coordinator_parser.add_argument('--lease-timeout', type=float, default=60,
+                                    help="seconds without a heartbeat before a unit is reassigned")
+    coordinator_parser.add_argument('--max-attempts', type=int, default=3)
+    coordinator_parser.add_argument('--local-workers', type=int, default=0)
+    worker_parser = subparsers.add_parser('worker', help="solve units from a coordinator")
+    worker_parser.add_argument('--queue', required=True, help="tcp:HOST:PORT or dir:PATH")
+    worker_parser.add_argument('--name', default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.command == 'worker':
+        solved = run_worker(open_queue(args.queue), args.name)
+        logging.info(f"Worker finished after {solved} scenarios")
+        return 0
+
+    plant = default_registry().get(args.site)
+    rows, failed = run_coordinator(args.queue, plant, args.output, args.max_down, args.unit_size,
+                                   args.lease_timeout, args.max_attempts, args.local_workers)
+    print(f"{rows} scenarios in {args.output}")
+    for unit, error in failed:
+        print(f"Unit {unit['id']} (cases {unit['start']}-{unit['stop'] - 1}) failed: {error}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Equipment-status feeds. A feed delivers status updates as dicts mapping
+equipment names to True (available) or False (down) to a callback; partial
+updates only mention the equipment that changed.
+
+Feeds are selected with a spec string, e.g. from KELANIS_STATUS_FEED:
+    file:C:/plant/status.json     poll a JSON file for changes
+    tcp:0.0.0.0:5555              accept newline-delimited JSON messages
+    local:                        in-process stand-in, driven with publish()
+Other message buses can be plugged in with register_feed_type().
+"""
+
+import json
+import logging
+import os
+import socketserver
+import threading
+
+UP_WORDS = {'up', 'on', 'online', 'available', 'true', '1'}
+DOWN_WORDS = {'down', 'off', 'offline', 'unavailable', 'false', '0'}
+
+
+def parse_status(text):
+    # Accepts {"H3": false, "L17": "down"} or {"equipment": {...}}
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError("Status message must be a JSON object")
+    if isinstance(data.get('equipment'), dict):
+        data = data['equipment']
+
+    status = {}
+    for name, value in data.items():
+        if isinstance(value, bool):
+            status[name] = value
+        elif str(value).strip().lower() in UP_WORDS:
+            status[name] = True
+        elif str(value).strip().lower() in DOWN_WORDS:
+            status[name] = False
+        else:
+            raise ValueError(f"Unknown status {value!r} for {name}")
+    return status
+
+
+class LocalStatusFeed:
+    # In-process stand-in for a real feed, also the base for other feeds
+
+    def __init__(self):
+        self.callback = None
+
+    def start(self, callback):
+        self.callback = callback
+
+    def stop(self):
+        self.callback = None
+
+    def publish(self, status):
+        if self.callback is not None:
+            self.callback(dict(status))
+
+    def publish_text(self, text):
+        try:
+            self.publish(parse_status(text))
+        except ValueError as e:
+            logging.error(f"Ignoring bad status message: {e}")
+
+
+class FileStatusFeed(LocalStatusFeed):
+    # Polls a JSON status file and publishes its content whenever it changes
+
+    def __init__(self, path, interval=1.0):
+        super().__init__()
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_mtime = None
+
+    def start(self, callback):
+        super().start(callback)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._poll, name='FileStatusFeed', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        super().stop()
+
+    def _poll(self):
+        while not self._stop.is_set():
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime != self._last_mtime:
+                    self._last_mtime = mtime
+                    with open(self.path, encoding='utf-8') as f:
+                        self.publish_text(f.read())
+            except OSError:
+                pass
+            self._stop.wait(self.interval)
+
+
+class _StatusHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode('utf-8').strip()
+            if line:
+                self.server.feed.publish_text(line)
+
+
+class TcpStatusFeed(LocalStatusFeed):
+    # Listens for newline-delimited JSON status messages
+
+    def __init__(self, host, port):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def start(self, callback):
+        super().start(callback)
+        self._server = socketserver.ThreadingTCPServer((self.host, self.port), _StatusHandler)
+        self._server.daemon_threads = True
+        self._server.feed = self
+        # Report the real port when 0 asked the OS to pick one
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name='TcpStatusFeed', daemon=True).start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        super().stop()
+
+
+FEED_TYPES = {
+    'local': lambda arg: LocalStatusFeed(),
+    'file': lambda arg: FileStatusFeed(arg),
+    'tcp': lambda arg: TcpStatusFeed(arg.rsplit(':', 1)[0] or '127.0.0.1', int(arg.rsplit(':', 1)[1])),
+}
+
+
+def register_feed_type(scheme, factory):
+    # `factory(arg)` must return an object with start(callback) and stop()
+    FEED_TYPES[scheme] = factory
+
+
+def create_feed(spec):
+    scheme, _, arg = spec.partition(':')
+    if scheme not in FEED_TYPES:
+        raise ValueError(f"Unknown status feed type {scheme!r}")
+    return FEED_TYPES[scheme](arg)
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Solve history in an embedded SQLite database.
+
+Every solve is stored with its site, time, active-equipment bitmask, status,
+objective and per-edge flows. Writes are batched on a background thread.
+Bitmasks are stored as hex text, since large plants have more than the 63
+units a SQLite INTEGER can hold. For equipment filters the mask is also
+split into 63-bit words: word 0 (every unit of plants up to 63 units) is the
+config0 column, covered by the solves_filter index, and higher words go to
+config_words. Filters are then integer bit operations inside SQLite.
+The store also works as a warm cache: a configuration that has been solved
+to a proven status before, for an unchanged plant and model version, is
+answered from the database.
+"""
+
+import hashlib
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+
+from kelanis_model import MODEL_VERSION
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS solves (
+    id INTEGER PRIMARY KEY,
+    site TEXT NOT NULL,
+    plant_hash TEXT NOT NULL,
+    model_version INTEGER NOT NULL DEFAULT 0,
+    solved_at REAL NOT NULL,
+    config TEXT NOT NULL,
+    config0 INTEGER NOT NULL DEFAULT 0,
+    tag TEXT NOT NULL,
+    status TEXT NOT NULL,
+    objective REAL NOT NULL,
+    solve_time REAL,
+    solution BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS solves_time ON solves (site, solved_at);
+CREATE INDEX IF NOT EXISTS solves_config ON solves (site, config, plant_hash, model_version);
+-- Covers the analytics filters, so they never read the solution blobs
+CREATE INDEX IF NOT EXISTS solves_filter ON solves (site, tag, solved_at, status, config0);
+
+CREATE TABLE IF NOT EXISTS flows (
+    solve_id INTEGER NOT NULL REFERENCES solves (id),
+    source TEXT NOT NULL,
+    jetty TEXT NOT NULL,
+    outloading TEXT NOT NULL,
+    tonnes REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS flows_solve ON flows (solve_id, outloading);
+
+-- Non-zero 63-bit words above word 0 of each solve's config mask; a missing word is all zeros
+CREATE TABLE IF NOT EXISTS config_words (
+    solve_id INTEGER NOT NULL REFERENCES solves (id),
+    word INTEGER NOT NULL,
+    bits INTEGER NOT NULL,
+    PRIMARY KEY (solve_id, word)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS portfolio_wins (
+    site TEXT NOT NULL,
+    scenario_class TEXT NOT NULL,
+    configuration TEXT NOT NULL,
+    solve_time REAL NOT NULL,
+    solved_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS portfolio_wins_class ON portfolio_wins (scenario_class);
+"""
+SCHEMA_VERSION = 4
+
+# Statuses the solver proved; anything else is not worth serving from the cache
+PROVEN_STATUSES = ('Optimal', 'Infeasible')
+
+# Solves of the plant as it actually was, as opposed to contingency / what-if variants
+REAL_TAGS = ('solve', 'feed')
+
+WORD_BITS = 63
+
+
+def plant_equipment(plant):
+    return list(plant['hoppers']) + list(plant['reclaimers']) + list(plant['outloadings'])
+
+
+def config_mask(plant, active_hoppers, active_reclaimers, active_outloadings):
+    # Bit i is set when the i-th piece of equipment (hoppers, reclaimers, outloadings) is active
+    active = set(active_hoppers) | set(active_reclaimers) | set(active_outloadings)
+    return sum(1 << i for i, name in enumerate(plant_equipment(plant)) if name in active)
+
+
+def equipment_bit(plant, name):
+    return 1 << plant_equipment(plant).index(name)
+
+
+def config_key(mask):
+    return format(mask, 'x')
+
+
+def mask_words(mask):
+    # {word index: bits} for the non-zero 63-bit words of a mask, each small enough for a SQLite INTEGER
+    words = {}
+    word = 0
+    while mask:
+        if mask & ((1 << WORD_BITS) - 1):
+            words[word] = mask & ((1 << WORD_BITS) - 1)
+        mask >>= WORD_BITS
+        word += 1
+    return words
+
+
+def migrate(connection):
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    exists = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'solves'").fetchone()
+    if exists and version < 2:
+        # Version 1 stored the bitmask as INTEGER; rebuild the table with hex text
+        connection.executescript("""
+            PRAGMA legacy_alter_table = ON;
+            DROP INDEX IF EXISTS solves_time;
+            DROP INDEX IF EXISTS solves_config;
+            ALTER TABLE solves RENAME TO solves_v1;
+            PRAGMA legacy_alter_table = OFF;
+        """)
+        connection.executescript(SCHEMA)
+        connection.execute(
+            "INSERT INTO solves (id, site, plant_hash, solved_at, config, tag, status, objective, solve_time, solution) "
+            "SELECT id, site, plant_hash, solved_at, printf('%x', config), tag, status, objective, solve_time, solution "
+            "FROM solves_v1")
+        connection.execute("DROP TABLE solves_v1")
+    elif exists and version < 4:
+        if version < 3:
+            # Version 2 had no model version; older rows keep 0 and are never served from the cache
+            connection.executescript("""
+                ALTER TABLE solves ADD COLUMN model_version INTEGER NOT NULL DEFAULT 0;
+                DROP INDEX IF EXISTS solves_config;
+            """)
+        connection.execute("ALTER TABLE solves ADD COLUMN config0 INTEGER NOT NULL DEFAULT 0")
+    connection.executescript(SCHEMA)
+    if exists and version < 4:
+        # Versions before 4 only had the hex text
+        words = [(solve_id, mask_words(int(config, 16)))
+                 for solve_id, config in connection.execute("SELECT id, config FROM solves").fetchall()]
+        connection.executemany("UPDATE solves SET config0 = ? WHERE id = ?",
+                               [(w.get(0, 0), solve_id) for solve_id, w in words])
+        connection.executemany("INSERT OR IGNORE INTO config_words (solve_id, word, bits) VALUES (?, ?, ?)",
+                               [(solve_id, word, bits) for solve_id, w in words for word, bits in w.items() if word])
+    connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    connection.commit()
+
+
+def plant_hash(plant):
+    return hashlib.sha1(json.dumps(plant, sort_keys=True, default=list).encode('utf-8')).hexdigest()
+
+
+def encode_solution(solution):
+    data = dict(solution)
+    data['flow'] = [[*key, f] for key, f in solution['flow'].items()]
+    data['reclaim_flow'] = [[*key, f] for key, f in solution['reclaim_flow'].items()]
+    return zlib.compress(json.dumps(data).encode('utf-8'))
+
+
+def decode_solution(blob):
+    data = json.loads(zlib.decompress(blob).decode('utf-8'))
+    data['flow'] = {(h, j, o): f for h, j, o, f in data['flow']}
+    data['reclaim_flow'] = {(r, j, o): f for r, j, o, f in data['reclaim_flow']}
+    return data
+
+
+class SolveHistory:
+    def __init__(self, path, batch_size=50, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        connection = sqlite3.connect(path)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            migrate(connection)
+        finally:
+            connection.close()
+        # Readers get their own connection per thread; the writer thread owns another
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='SolveHistory', daemon=True)
+        self._writer.start()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path)
+        return connection
+
+    def record(self, plant, solution, tag='solve', solved_at=None):
+        mask = config_mask(plant, solution['active_hoppers'], solution['active_reclaimers'],
+                           solution['active_outloadings'])
+        self._queue.put(('solve', plant['name'], plant_hash(plant), MODEL_VERSION, solved_at or time.time(),
+                         mask, tag, solution))
+
+    def record_portfolio_win(self, site, scenario_class, configuration, solve_time):
+        self._queue.put(('win', site, scenario_class, configuration, solve_time, time.time()))
+
+    def flush(self):
+        # Block until everything recorded so far is committed
+        if not self._writer.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        # Poll so a writer that died after the check cannot leave us waiting forever
+        while not done.wait(0.5):
+            if not self._writer.is_alive():
+                return
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write_loop(self):
+        connection = sqlite3.connect(self.path)
+        batch = []
+        waiters = []
+        running = True
+        while running:
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+
+            try:
+                if batch:
+                    self._write_batch(connection, batch)
+            except Exception:
+                # Write one at a time so a bad record only loses itself. Nothing may escape
+                # the loop: a dead writer would leave flush() and close() waiting forever.
+                for item in batch:
+                    try:
+                        self._write_batch(connection, [item])
+                    except Exception as e:
+                        logging.error(f"Could not write solve history: {e}")
+            finally:
+                batch = []
+                for waiter in waiters:
+                    waiter.set()
+                waiters = []
+        connection.close()
+
+    def _write_batch(self, connection, batch):
+        with connection:
+            wins = [item[1:] for item in batch if item[0] == 'win']
+            connection.executemany(
+                "INSERT INTO portfolio_wins (site, scenario_class, configuration, solve_time, solved_at) "
+                "VALUES (?, ?, ?, ?, ?)", wins)
+
+            for _, site, hash_, version, solved_at, mask, tag, solution in (item for item in batch
+                                                                              if item[0] == 'solve'):
+                words = mask_words(mask)
+                cursor = connection.execute(
+                    "INSERT INTO solves (site, plant_hash, model_version, solved_at, config, config0, tag, status, "
+                    "objective, solve_time, solution) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (site, hash_, version, solved_at, config_key(mask), words.get(0, 0), tag, solution['status'],
+                     solution['objective'], solution.get('solve_time'), encode_solution(solution)))
+                solve_id = cursor.lastrowid
+                connection.executemany("INSERT INTO config_words (solve_id, word, bits) VALUES (?, ?, ?)",
+                                       [(solve_id, word, bits) for word, bits in words.items() if word])
+                rows = [(solve_id, h, j, o, f) for (h, j, o), f in solution['flow'].items() if f > 0]
+                rows += [(solve_id, r, j, o, f) for (r, j, o), f in solution['reclaim_flow'].items() if f > 0]
+                connection.executemany(
+                    "INSERT INTO flows (solve_id, source, jetty, outloading, tonnes) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def lookup(self, plant, active_hoppers, active_reclaimers, active_outloadings):
+        # Most recent proven solution for this exact configuration of an unchanged plant and model
+        mask = config_mask(plant, active_hoppers, active_reclaimers, active_outloadings)
+        row = self._connection().execute(
+            "SELECT solution FROM solves WHERE site = ? AND config = ? AND plant_hash = ? AND model_version = ? "
+            f"AND status IN ({', '.join('?' * len(PROVEN_STATUSES))}) ORDER BY solved_at DESC LIMIT 1",
+            (plant['name'], config_key(mask), plant_hash(plant), MODEL_VERSION, *PROVEN_STATUSES)).fetchone()
+        return decode_solution(row[0]) if row else None
+
+    def portfolio_wins(self, scenario_class):
+        rows = self._connection().execute(
+            "SELECT configuration, COUNT(*) FROM portfolio_wins WHERE scenario_class = ? GROUP BY configuration",
+            (scenario_class,)).fetchall()
+        return dict(rows)
+
+    def portfolio_summary(self):
+        return self._connection().execute(
+            "SELECT scenario_class, configuration, COUNT(*), AVG(solve_time) FROM portfolio_wins "
+            "GROUP BY scenario_class, configuration ORDER BY scenario_class, COUNT(*) DESC").fetchall()
+
+    def average_outloading_tonnage(self, plant, outloading, down=(), up=(), since=None, until=None,
+                                   tags=REAL_TAGS, feasible_only=True, outloading_active=True):
+        # e.g. average achievable L20 tonnage when L17 was down last month:
+        #   history.average_outloading_tonnage(plant, 'L20', down=['L17'], since=month_start, until=month_end)
+        # Only solves with L20 itself running count; pass outloading_active=False to
+        # include those where it was down, at 0 t. Contingency and what-if variants are
+        # hypothetical and left out unless `tags` names them (None: every tag)
+        down_words = mask_words(sum(equipment_bit(plant, name) for name in down))
+        up_words = mask_words(sum(equipment_bit(plant, name)
+                                  for name in set(up) | ({outloading} if outloading_active else set())))
+        joins, conditions, join_params, params = "", "", [], []
+        for word in sorted(set(down_words) | set(up_words) | {0}):
+            if word == 0:
+                bits = "s.config0"
+            else:
+                # A solve without a row for this word has all of its bits clear
+                joins += f" LEFT JOIN config_words w{word} ON w{word}.solve_id = s.id AND w{word}.word = ?"
+                join_params.append(word)
+                bits = f"COALESCE(w{word}.bits, 0)"
+            conditions += f" AND ({bits} & ?) = 0 AND ({bits} & ?) = ?"
+            params += [down_words.get(word, 0), up_words.get(word, 0), up_words.get(word, 0)]
+
+        query = ("SELECT AVG(total), COUNT(*) FROM ("
+                 f" SELECT COALESCE(SUM(f.tonnes), 0) AS total FROM solves s{joins}"
+                 " LEFT JOIN flows f ON f.solve_id = s.id AND f.outloading = ?"
+                 f" WHERE s.site = ?{conditions}")
+        params = join_params + [outloading, plant['name']] + params
+        if since is not None:
+            query += " AND s.solved_at >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND s.solved_at < ?"
+            params.append(until)
+        if tags is not None:
+            query += f" AND s.tag IN ({', '.join('?' * len(tags))})"
+            params += list(tags)
+        if feasible_only:
+            query += " AND s.status = 'Optimal'"
+        query += " GROUP BY s.id)"
+        average, count = self._connection().execute(query, params).fetchone()
+        return average, count
@@ -0,0 +1,639 @@
+# -*- coding: utf-8 -*-
+"""
+Kelanis network flow model, independent of the Qt front end so it can be
+solved from worker threads, batch scripts and the command line.
+"""
+
+import logging
+import os
+import time
+
+import pulp
+
+from kelanis_profiling import profile_stage
+
+# Plant definition
+HOPPERS = ['H1', 'H2', 'H3', 'H4', 'H5', 'H6', 'H7']
+RECLAIMERS = ['L3', 'L1', 'L2', 'L8', 'L21', 'L16', 'L17', 'L18', 'L19']
+OUTLOADINGS = ['L4', 'L6', 'L26', 'L20', 'L9', 'L29']
+
+JETTIES = {'K1': ['L4', 'L6', 'L26'], 'K3': ['L20', 'L9', 'L29']}
+
+HOPPER_CAPACITY = {
+    'H1': 600, 'H2': 1300, 'H3': 1150, 'H4': 1000,
+    'H5': 2300, 'H6': 1350, 'H7': 1450
+}
+
+RECLAIMER_CAPACITY = {
+    'L3': 1050, 'L1': 1100, 'L2': 800, 'L8': 1050,
+    'L21': 1450, 'L16': 800, 'L17': 950, 'L18': 1000, 'L19': 800
+}
+
+OUTLOADING_TARGET = {
+    'L4': 1400, 'L6': 1250, 'L26': 1550,
+    'L20': 2250, 'L9': 1750, 'L29': 1950
+}
+
+ALLOWED_FLOWS = {
+    'H1': ['L4'],
+    'H2': ['L4', 'L26'],
+    'H3': ['L20'],
+    'H4': ['L20'],
+    'H5': ['L9', 'L6'],
+    'H6': ['L6', 'L26'],
+    'H7': ['L29', 'L26']
+}
+
+ALLOWED_RECLAIM_FLOWS = {
+    'L3': ['L4', 'L6'],
+    'L1': ['L4'],
+    'L2': ['L26'],
+    'L8': ['L9'],
+    'L21': ['L29', 'L26'],
+    'L16': ['L29', 'L26'],
+    'L17': ['L20'],
+    'L18': ['L20'],
+    'L19': ['L20']
+}
+
+# Hopper / reclaimer share of the jetty target: (hopper_min, hopper_max, reclaimer_min, reclaimer_max)
+JETTY_SHARE = {
+    'K1': (0, 1.0, 0, 1.0),
+    'K3': (0.6, 1.0, 0, 1.0),
+}
+
+# (hopper, reclaimer, outloading): the hopper and reclaimer cannot both feed the outloading
+EXCLUSIVE_PAIRS = [('H5', 'L8', 'L9')]
+
+# (reclaimer, reclaimer, outloadings): the two reclaimers may only run together on the same outloading
+PAIRED_RECLAIMERS = [('L16', 'L21', ('L29', 'L26'))]
+
+# A plant bundles every table the model needs, so other sites can be described the same way
+KELANIS_PLANT = {
+    'name': 'Kelanis',
+    'hoppers': HOPPERS,
+    'reclaimers': RECLAIMERS,
+    'outloadings': OUTLOADINGS,
+    'jetties': JETTIES,
+    'hopper_capacity': HOPPER_CAPACITY,
+    'reclaimer_capacity': RECLAIMER_CAPACITY,
+    'outloading_target': OUTLOADING_TARGET,
+    'allowed_flows': ALLOWED_FLOWS,
+    'allowed_reclaim_flows': ALLOWED_RECLAIM_FLOWS,
+    'jetty_share': JETTY_SHARE,
+    'exclusive_pairs': EXCLUSIVE_PAIRS,
+    'paired_reclaimers': PAIRED_RECLAIMERS,
+}
+
+
+def build_model(active_hoppers, active_reclaimers, active_outloadings, plant=KELANIS_PLANT):
+    # Initialize problem
+    prob = pulp.LpProblem("Network_Flow_Optimization", pulp.LpMaximize)
+
+    # Define variables
+    active_jetties = {j: [o for o in ol if o in active_outloadings] for j, ol in plant['jetties'].items()}
+    active_jetties = {j: ol for j, ol in active_jetties.items() if ol}
+
+    hopper_capacity = plant['hopper_capacity']
+    reclaimer_capacity = plant['reclaimer_capacity']
+    outloading_target = plant['outloading_target']
+    allowed_flows = plant['allowed_flows']
+    allowed_reclaim_flows = plant['allowed_reclaim_flows']
+
+    # Create decision variables
+    flow = pulp.LpVariable.dicts("flow",
+                                 ((h, j, o) for h in active_hoppers for j in active_jetties for o in active_jetties[j]),
+                                 lowBound=0,
+                                 cat='Continuous')
+
+    reclaim_flow = pulp.LpVariable.dicts("reclaim_flow",
+                                         ((r, j, o) for r in active_reclaimers for j in active_jetties for o in active_jetties[j]),
+                                         lowBound=0,
+                                         cat='Continuous')
+
+    hopper_use = pulp.LpVariable.dicts("hopper_use",
+                                       ((h, o) for h in active_hoppers for o in active_outloadings),
+                                       cat='Binary')
+
+    reclaimer_use = pulp.LpVariable.dicts("reclaimer_use",
+                                          ((r, o) for r in active_reclaimers for o in active_outloadings),
+                                          cat='Binary')
+
+    # Objective function
+    prob += pulp.lpSum(flow[h,j,o] for h in active_hoppers for j in active_jetties for o in active_jetties[j]) + \
+            pulp.lpSum(reclaim_flow[r,j,o] for r in active_reclaimers for j in active_jetties for o in active_jetties[j])
+
+    # Constraints
+    # Hopper capacity constraints
+    for h in active_hoppers:
+        prob += pulp.lpSum(flow[h,j,o] for j in active_jetties for o in active_jetties[j]) <= hopper_capacity[h]
+
+    # Reclaimer capacity constraints
+    for r in active_reclaimers:
+        prob += pulp.lpSum(reclaim_flow[r,j,o] for j in active_jetties for o in active_jetties[j]) <= reclaimer_capacity[r]
+
+    # Hopper flow constraints
+    for h in active_hoppers:
+        for j in active_jetties:
+            for o in active_jetties[j]:
+                if o not in allowed_flows[h] or o not in active_outloadings:
+                    prob += flow[h,j,o] == 0
+
+    # Reclaimer flow constraints
+    for r in active_reclaimers:
+        for j in active_jetties:
+            for o in active_jetties[j]:
+                if o not in allowed_reclaim_flows[r] or o not in active_outloadings:
+                    prob += reclaim_flow[r,j,o] == 0
+                else:
+                    # Add this constraint to ensure flow is only allowed for permitted combinations
+                    prob += reclaim_flow[r,j,o] <= reclaimer_capacity[r] * reclaimer_use[r,o]
+
+    # Ensure reclaimer is only used for allowed outloadings
+    for r in active_reclaimers:
+        for o in active_outloadings:
+            if o not in allowed_reclaim_flows[r]:
+                prob += reclaimer_use[r,o] == 0
+
+    # Outloading target constraints
+    for o in active_outloadings:
+        prob += pulp.lpSum(flow[h,j,o] for h in active_hoppers for j in active_jetties if o in active_jetties[j]) + \
+                pulp.lpSum(reclaim_flow[r,j,o] for r in active_reclaimers for j in active_jetties if o in active_jetties[j]) >= 0.8 * outloading_target[o]
+        prob += pulp.lpSum(flow[h,j,o] for h in active_hoppers for j in active_jetties if o in active_jetties[j]) + \
+                pulp.lpSum(reclaim_flow[r,j,o] for r in active_reclaimers for j in active_jetties if o in active_jetties[j]) <= 1.7 * outloading_target[o]
+
+    # Hopper usage constraints
+    for h in active_hoppers:
+        # Ensure each hopper is used exactly once
+        prob += pulp.lpSum(hopper_use[h,o] for o in active_outloadings) == 1
+
+        # Link flow to usage and ensure at least 10% capacity utilization when used
+        for o in active_outloadings:
+            prob += pulp.lpSum(flow[h,j,o] for j in active_jetties if o in active_jetties[j]) >= 0.9 * hopper_capacity[h] * hopper_use[h,o]
+            prob += pulp.lpSum(flow[h,j,o] for j in active_jetties if o in active_jetties[j]) <= 1.2 * hopper_capacity[h] * hopper_use[h,o]
+
+        # Ensure flow is zero if hopper is not used
+        for j in active_jetties:
+            for o in active_jetties[j]:
+                prob += flow[h,j,o] <= hopper_capacity[h] * hopper_use[h,o]
+
+    # Exclusive pairs, e.g. H5 and L8 to L9
+    for eh, er, eo in plant['exclusive_pairs']:
+        if eh not in active_hoppers or er not in active_reclaimers or eo not in active_outloadings:
+            continue
+        hopper_to_o = pulp.LpVariable(f"{eh}_to_{eo}".lower(), cat='Binary')
+        reclaimer_to_o = pulp.LpVariable(f"{er}_to_{eo}".lower(), cat='Binary')
+
+        # Link the hopper indicator to the actual flow
+        for j in active_jetties:
+            if eo in active_jetties[j]:
+                prob += flow[eh, j, eo] <= hopper_capacity[eh] * hopper_to_o
+                prob += flow[eh, j, eo] >= hopper_to_o  # Ensure the indicator is 1 if there's any flow
+
+        # Link the reclaimer indicator to the actual flow
+        for j in active_jetties:
+            if eo in active_jetties[j]:
+                prob += reclaim_flow[er, j, eo] <= reclaimer_capacity[er] * reclaimer_to_o
+                prob += reclaim_flow[er, j, eo] >= reclaimer_to_o  # Ensure the indicator is 1 if there's any flow
+
+        # The hopper and reclaimer cannot both send to the outloading simultaneously
+        prob += hopper_to_o + reclaimer_to_o <= 1
+
+    # Reclaimer usage constraints
+    for r in active_reclaimers:
+        # Ensure each reclaimer is used at most once
+        prob += pulp.lpSum(reclaimer_use[r,o] for o in active_outloadings) <= 1
+
+        # Link flow to usage
+        for o in active_outloadings:
+            prob += pulp.lpSum(reclaim_flow[r,j,o] for j in active_jetties if o in active_jetties[j]) <= reclaimer_capacity[r] * reclaimer_use[r,o]
+
+        # Ensure flow is zero if reclaimer is not used
+        for j in active_jetties:
+            for o in active_jetties[j]:
+                prob += reclaim_flow[r,j,o] <= reclaimer_capacity[r] * reclaimer_use[r,o]
+
+    # Paired reclaimers, e.g. L16 & L21
+    for ra, rb, (o1, o2) in plant['paired_reclaimers']:
+        if ra not in active_reclaimers or rb not in active_reclaimers:
+            continue
+        # The pair can be used simultaneously for the same outloading,
+        # but cannot be used simultaneously for different outloadings
+        if o1 in active_outloadings and o2 in active_outloadings:
+            prob += reclaimer_use[ra,o1] + reclaimer_use[rb,o2] <= 1
+            prob += reclaimer_use[ra,o2] + reclaimer_use[rb,o1] <= 1
+
+        # Ensure that at most one of the pair is used if outloadings are different
+        # Create a new binary variable for each outloading
+        min_use = pulp.LpVariable.dicts(f"min_use_{ra}_{rb}", (o for o in active_outloadings), cat='Binary')
+
+        for o in active_outloadings:
+            # Ensure min_use[o] is less than or equal to both reclaimer_use[ra,o] and reclaimer_use[rb,o]
+            prob += min_use[o] <= reclaimer_use[ra,o]
+            prob += min_use[o] <= reclaimer_use[rb,o]
+
+            # Ensure min_use[o] is greater than or equal to reclaimer_use[ra,o] + reclaimer_use[rb,o] - 1
+            # This constraint, combined with the two above, ensures min_use[o] = min(reclaimer_use[ra,o], reclaimer_use[rb,o])
+            prob += min_use[o] >= reclaimer_use[ra,o] + reclaimer_use[rb,o] - 1
+
+        # Add the constraint using the new min_use variables
+        prob += pulp.lpSum(reclaimer_use[ra,o] for o in active_outloadings) + \
+                pulp.lpSum(reclaimer_use[rb,o] for o in active_outloadings) <= 1 + \
+                pulp.lpSum(min_use[o] for o in active_outloadings)
+
+    # Percentage constraints for Hopper and Reclaimer on each jetty
+    for j, (hopper_min, hopper_max, reclaimer_min, reclaimer_max) in plant['jetty_share'].items():
+        if j not in active_jetties:
+            continue
+        target_outloading_j = sum(outloading_target[o] for o in active_jetties[j])
+        hopper_j = pulp.lpSum(flow[h,j,o] for h in active_hoppers for o in active_jetties[j])
+        reclaimer_j = pulp.lpSum(reclaim_flow[r,j,o] for r in active_reclaimers for o in active_jetties[j])
+
+        prob += hopper_j >= hopper_min * target_outloading_j
+        prob += hopper_j <= hopper_max * target_outloading_j
+        prob += reclaimer_j >= reclaimer_min * target_outloading_j
+        prob += reclaimer_j <= reclaimer_max * target_outloading_j
+
+    variables = {'flow': flow, 'reclaim_flow': reclaim_flow,
+                 'hopper_use': hopper_use, 'reclaimer_use': reclaimer_use}
+    return prob, active_jetties, variables
+
+
+def build_tight_model(active_hoppers, active_reclaimers, active_outloadings, plant=KELANIS_PLANT, symmetry_breaking=True):
+    # Same feasible flows and objective as build_model, with a stronger LP relaxation:
+    # - big-M values are the tightest bound from capacity and the 1.7 x target ceiling,
+    #   and routes that cannot be used are fixed by variable bounds instead of rows
+    # - the H5/L8 -> L9 style rules reuse the use binaries instead of new indicators
+    # - the L16/L21 style rule is a direct inequality instead of min_use binaries
+    # - target and jetty share constraints are repeated on the use binaries as cuts
+    # - identical hoppers / reclaimers are ordered to break symmetry
+    # Variable names match build_model, so warm starts work across formulations.
+    prob = pulp.LpProblem("Network_Flow_Optimization", pulp.LpMaximize)
+
+    active_jetties = {j: [o for o in ol if o in active_outloadings] for j, ol in plant['jetties'].items()}
+    active_jetties = {j: ol for j, ol in active_jetties.items() if ol}
+    jetty_of = {o: j for j, ol in active_jetties.items() for o in ol}
+
+    hopper_capacity = plant['hopper_capacity']
+    reclaimer_capacity = plant['reclaimer_capacity']
+    outloading_target = plant['outloading_target']
+    allowed_flows = plant['allowed_flows']
+    allowed_reclaim_flows = plant['allowed_reclaim_flows']
+
+    flow = pulp.LpVariable.dicts("flow",
+                                 ((h, j, o) for h in active_hoppers for j in active_jetties for o in active_jetties[j]),
+                                 lowBound=0,
+                                 cat='Continuous')
+
+    reclaim_flow = pulp.LpVariable.dicts("reclaim_flow",
+                                         ((r, j, o) for r in active_reclaimers for j in active_jetties for o in active_jetties[j]),
+                                         lowBound=0,
+                                         cat='Continuous')
+
+    hopper_use = pulp.LpVariable.dicts("hopper_use",
+                                       ((h, o) for h in active_hoppers for o in active_outloadings),
+                                       cat='Binary')
+
+    reclaimer_use = pulp.LpVariable.dicts("reclaimer_use",
+                                          ((r, o) for r in active_reclaimers for o in active_outloadings),
+                                          cat='Binary')
+
+    # Largest flow a hopper / reclaimer can send to an outloading (0 when not routed)
+    hopper_m = {(h, o): min(hopper_capacity[h], 1.7 * outloading_target[o]) if o in allowed_flows[h] else 0
+                for h in active_hoppers for o in active_outloadings}
+    reclaimer_m = {(r, o): min(reclaimer_capacity[r], 1.7 * outloading_target[o]) if o in allowed_reclaim_flows[r] else 0
+                   for r in active_reclaimers for o in active_outloadings}
+
+    for (h, o), m in hopper_m.items():
+        flow[h, jetty_of[o], o].upBound = m
+        # A used hopper sends at least 90% of its capacity, so it cannot use an outloading capped below that
+        if m < 0.9 * hopper_capacity[h]:
+            hopper_use[h, o].upBound = 0
+    for (r, o), m in reclaimer_m.items():
+        reclaim_flow[r, jetty_of[o], o].upBound = m
+        if m == 0:
+            reclaimer_use[r, o].upBound = 0
+
+    # Objective function
+    prob += pulp.lpSum(flow.values()) + pulp.lpSum(reclaim_flow.values())
+
+    # Each hopper is used exactly once, at 90% to 100% of capacity;
+    # the capacity row of build_model is implied by the per-outloading bound
+    for h in active_hoppers:
+        prob += pulp.lpSum(hopper_use[h, o] for o in active_outloadings) == 1
+        for o in active_outloadings:
+            prob += flow[h, jetty_of[o], o] >= 0.9 * hopper_capacity[h] * hopper_use[h, o]
+            prob += flow[h, jetty_of[o], o] <= hopper_m[h, o] * hopper_use[h, o]
+
+    # Each reclaimer is used at most once
+    for r in active_reclaimers:
+        prob += pulp.lpSum(reclaimer_use[r, o] for o in active_outloadings) <= 1
+        for o in active_outloadings:
+            prob += reclaim_flow[r, jetty_of[o], o] <= reclaimer_m[r, o] * reclaimer_use[r, o]
+
+    # Outloading targets, plus the same bounds on the use binaries
+    for o in active_outloadings:
+        total = pulp.lpSum(flow[h, jetty_of[o], o] for h in active_hoppers) + \
+                pulp.lpSum(reclaim_flow[r, jetty_of[o], o] for r in active_reclaimers)
+        prob += total >= 0.8 * outloading_target[o]
+        prob += total <= 1.7 * outloading_target[o]
+        prob += pulp.lpSum(hopper_m[h, o] * hopper_use[h, o] for h in active_hoppers) + \
+                pulp.lpSum(reclaimer_m[r, o] * reclaimer_use[r, o] for r in active_reclaimers) >= 0.8 * outloading_target[o]
+        prob += pulp.lpSum(0.9 * hopper_capacity[h] * hopper_use[h, o] for h in active_hoppers) <= 1.7 * outloading_target[o]
+
+    # Exclusive pairs, e.g. H5 and L8 to L9: flow implies use, so the use binaries are the indicators
+    for eh, er, eo in plant['exclusive_pairs']:
+        if eh not in active_hoppers or er not in active_reclaimers or eo not in active_outloadings:
+            continue
+        prob += hopper_use[eh, eo] + reclaimer_use[er, eo] <= 1
+
+    # Paired reclaimers, e.g. L16 & L21: if one runs on an outloading, the other cannot run on any other
+    for ra, rb, _ in plant['paired_reclaimers']:
+        if ra not in active_reclaimers or rb not in active_reclaimers:
+            continue
+        for o in active_outloadings:
+            prob += reclaimer_use[ra, o] + pulp.lpSum(reclaimer_use[rb, p] for p in active_outloadings if p != o) <= 1
+
+    # Jetty shares, plus the same bounds on the use binaries
+    for j, (hopper_min, hopper_max, reclaimer_min, reclaimer_max) in plant['jetty_share'].items():
+        if j not in active_jetties:
+            continue
+        target_outloading_j = sum(outloading_target[o] for o in active_jetties[j])
+        hopper_j = pulp.lpSum(flow[h, j, o] for h in active_hoppers for o in active_jetties[j])
+        reclaimer_j = pulp.lpSum(reclaim_flow[r, j, o] for r in active_reclaimers for o in active_jetties[j])
+
+        prob += hopper_j >= hopper_min * target_outloading_j
+        prob += hopper_j <= hopper_max * target_outloading_j
+        prob += reclaimer_j >= reclaimer_min * target_outloading_j
+        prob += reclaimer_j <= reclaimer_max * target_outloading_j
+
+        if hopper_min > 0:
+            prob += pulp.lpSum(hopper_m[h, o] * hopper_use[h, o]
+                               for h in active_hoppers for o in active_jetties[j]) >= hopper_min * target_outloading_j
+        prob += pulp.lpSum(0.9 * hopper_capacity[h] * hopper_use[h, o]
+                           for h in active_hoppers for o in active_jetties[j]) <= hopper_max * target_outloading_j
+        if reclaimer_min > 0:
+            prob += pulp.lpSum(reclaimer_m[r, o] * reclaimer_use[r, o]
+                               for r in active_reclaimers for o in active_jetties[j]) >= reclaimer_min * target_outloading_j
+
+    # Symmetry breaking between interchangeable equipment; turned off to check a solution
+    # that was not built with it
+    if symmetry_breaking:
+        ruled = {name for rule in plant['exclusive_pairs'] for name in rule[:2]}
+        ruled |= {name for rule in plant['paired_reclaimers'] for name in rule[:2]}
+        index = {o: i for i, o in enumerate(active_outloadings)}
+        for group in _identical_groups(active_hoppers, hopper_capacity, allowed_flows, ruled):
+            for a, b in zip(group, group[1:]):
+                prob += pulp.lpSum(index[o] * hopper_use[a, o] for o in active_outloadings) <= \
+                        pulp.lpSum(index[o] * hopper_use[b, o] for o in active_outloadings)
+        for group in _identical_groups(active_reclaimers, reclaimer_capacity, allowed_reclaim_flows, ruled):
+            for a, b in zip(group, group[1:]):
+                prob += pulp.lpSum(reclaimer_use[a, o] for o in active_outloadings) >= \
+                        pulp.lpSum(reclaimer_use[b, o] for o in active_outloadings)
+
+    variables = {'flow': flow, 'reclaim_flow': reclaim_flow,
+                 'hopper_use': hopper_use, 'reclaimer_use': reclaimer_use}
+    return prob, active_jetties, variables
+
+
+def _identical_groups(equipment, capacity, routes, ruled):
+    # Equipment with the same capacity and routes and no special rules can be swapped freely
+    groups = {}
+    for name in equipment:
+        if name not in ruled:
+            groups.setdefault((capacity[name], tuple(sorted(routes[name]))), []).append(name)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+FORMULATIONS = {
+    'standard': build_model,
+    'tight': build_tight_model,
+}
+DEFAULT_FORMULATION = os.environ.get('KELANIS_FORMULATION', 'standard')
+
+# Bump whenever a change to the model or its formulations can change what a
+# configuration solves to; stored solutions from other versions are not reused
+MODEL_VERSION = 1
+
+
+def build_formulation(active_hoppers, active_reclaimers, active_outloadings, plant=KELANIS_PLANT, formulation=None):
+    formulation = formulation or DEFAULT_FORMULATION
+    if formulation not in FORMULATIONS:
+        raise ValueError(f"Unknown formulation {formulation!r}")
+    return FORMULATIONS[formulation](active_hoppers, active_reclaimers, active_outloadings, plant)
+
+
+def apply_warm_start(prob, warm_start):
+    # Seed variables with values from an earlier solution, matched by name.
+    # Variables that no longer exist (failed equipment) are simply skipped.
+    seeded = 0
+    for var in prob.variables():
+        value = warm_start.get(var.name)
+        if value is not None:
+            # Clamp solver round-off so pulp accepts the value
+            if var.lowBound is not None:
+                value = max(value, var.lowBound)
+            if var.upBound is not None:
+                value = min(value, var.upBound)
+            var.setInitialValue(value)
+            seeded += 1
+    return seeded
+
+
+def solve_checked(prob, solver=None):
+    prob.solve(solver)
+
+    # CBC preprocessing occasionally reports Optimal for a point that violates
+    # the model ("possible tolerance issue"); re-solve without it when that happens
+    if prob.status == pulp.LpStatusOptimal and not prob.valid(eps=1e-4):
+        logging.warning("CBC returned an invalid solution, re-solving without preprocessing")
+        retry = pulp.getSolverFromDict((solver or pulp.LpSolverDefault).toDict())
+        retry.options = list(retry.options) + ['preprocess off']
+        prob.solve(retry)
+    return prob.status
+
+
+def solve_network_flow(active_hoppers, active_reclaimers, active_outloadings, solver=None, warm_start=None,
+                       record_dir=None, plant=KELANIS_PLANT, formulation=None):
+    with profile_stage('build_model'):
+        prob, active_jetties, variables = build_formulation(active_hoppers, active_reclaimers, active_outloadings,
+                                                            plant, formulation)
+
+    if warm_start and apply_warm_start(prob, warm_start):
+        if solver is None:
+            solver = pulp.PULP_CBC_CMD(msg=False, warmStart=True)
+        else:
+            solver.optionsDict['warmStart'] = True
+
+    model_dict = snapshot_model(prob, record_dir)
+
+    # Solve the problem
+    start = time.perf_counter()
+    with profile_stage('solve'):
+        solve_checked(prob, solver)
+    solve_time = time.perf_counter() - start
+
+    return finish_solve(prob, active_hoppers, active_reclaimers, active_outloadings, active_jetties, variables,
+                        plant, solver, solve_time, model_dict, record_dir)
+
+
+# Shared by every solve path (solve_network_flow, kelanis_portfolio, kelanis_decomposition)
+# so recording and profiling behave the same whichever one is in use
+
+def snapshot_model(prob, record_dir=None):
+    # Taken before solving so a recorded bundle replays from the same start; None when not recording
+    return prob.toDict() if record_dir or os.environ.get('KELANIS_RECORD_DIR') else None
+
+
+def finish_solve(prob, active_hoppers, active_reclaimers, active_outloadings, active_jetties, variables, plant,
+                 solver, solve_time, model_dict=None, record_dir=None):
+    with profile_stage('extract_solution'):
+        solution = extract_solution(prob, active_hoppers, active_reclaimers, active_outloadings, active_jetties, variables)
+    solution['solve_time'] = solve_time
+    solution['site'] = plant['name']
+
+    record_solve(model_dict, solver, solution, record_dir)
+    return solution
+
+
+def record_solve(model_dict, solver, solution, record_dir=None):
+    record_dir = record_dir or os.environ.get('KELANIS_RECORD_DIR')
+    if record_dir and model_dict is not None:
+        from kelanis_replay import save_bundle
+        try:
+            save_bundle(record_dir, model_dict, solver or pulp.LpSolverDefault, solution)
+        except OSError as e:
+            logging.error(f"Could not record solve bundle: {e}")
+
+
+def extract_solution(prob, active_hoppers, active_reclaimers, active_outloadings, active_jetties, variables):
+    flow = variables['flow']
+    reclaim_flow = variables['reclaim_flow']
+    return {
+        'status': pulp.LpStatus[prob.status],
+        'objective': pulp.value(prob.objective) or 0,
+        'active_hoppers': list(active_hoppers),
+        'active_reclaimers': list(active_reclaimers),
+        'active_outloadings': list(active_outloadings),
+        'active_jetties': active_jetties,
+        'flow': {key: var.value() or 0 for key, var in flow.items()},
+        'reclaim_flow': {key: var.value() or 0 for key, var in reclaim_flow.items()},
+        'values': {var.name: var.value() for var in prob.variables() if var.value() is not None},
+    }
+
+
+def outloading_tonnage(solution):
+    # Total tonnage delivered to each active outloading
+    tonnage = {o: 0 for o in solution['active_outloadings']}
+    for (h, j, o), f in solution['flow'].items():
+        tonnage[o] += f
+    for (r, j, o), f in solution['reclaim_flow'].items():
+        tonnage[o] += f
+    return tonnage
+
+
+def format_solution(solution):
+    flow = solution['flow']
+    reclaim_flow = solution['reclaim_flow']
+    active_hoppers = solution['active_hoppers']
+    active_reclaimers = solution['active_reclaimers']
+    active_jetties = solution['active_jetties']
+
+    # Format and return results
+    result = f"Status: {solution['status']}\n"
+    result += "-----" * 30 + "\n"
+
+    for j, outloadings_j in active_jetties.items():
+        result += f"\nJetty {j} Summary:\n"
+
+        # Calculate Hopper summary
+        hopper_total = sum(flow[h,j,o] for h in active_hoppers for o in outloadings_j)
+        reclaimer_total = sum(reclaim_flow[r,j,o] for r in active_reclaimers for o in outloadings_j)
+        total_tonnage = hopper_total + reclaimer_total
+        hopper_percentage = (hopper_total / total_tonnage) * 100 if total_tonnage > 0 else 0
+        result += f"\nTotal tonase Hopper to Jetty {j}: {int(hopper_total)} | Persentase Hopper terhadap Reclaimer: {hopper_percentage:.0f}%\n"
+
+        hopper_flows = []
+        for h in active_hoppers:
+            for o in outloadings_j:
+                if flow[h,j,o] > 0:
+                    hopper_flows.append((h, o, flow[h,j,o]))
+
+        for i, (h, o, f) in enumerate(sorted(hopper_flows, key=lambda x: x[2], reverse=True), 1):
+            result += f"{i}. {h} to {o} | {int(f)}\n"
+
+        # Calculate Reclaimer summary
+        reclaimer_percentage = (reclaimer_total / total_tonnage) * 100 if total_tonnage > 0 else 0
+        result += f"\nTotal tonase Reclaimer to Jetty {j}: {int(reclaimer_total)} | Persentase Reclaimer terhadap Hopper: {reclaimer_percentage:.0f}%\n"
+
+        reclaimer_flows = []
+        for r in active_reclaimers:
+            for o in outloadings_j:
+                if reclaim_flow[r,j,o] > 0:
+                    reclaimer_flows.append((r, o, reclaim_flow[r,j,o]))
+
+        for i, (r, o, f) in enumerate(sorted(reclaimer_flows, key=lambda x: x[2], reverse=True), 1):
+            result += f"{i}. {r} to {o} | {int(f)}\n"
+
+        # Print total tonnage for each outloading line
+        result += "\n"
+        total_jetty_tonnage = hopper_total + reclaimer_total
+        result += f"Total tonnage for Jetty {j} = {int(total_jetty_tonnage)}/hour\n"
+        result += "-----" * 30 + "\n"
+
+    result += "\nOverall Summary:\n"
+    for o, total_tonnage in outloading_tonnage(solution).items():
+        result += f"{o} = {int(total_tonnage)}/hour\n"
+
+    return result
+
+
+def solution_matches(solution, active_hoppers, active_reclaimers, active_outloadings):
+    # True if the solution was solved for exactly this equipment configuration
+    return solution is not None and \
+        solution['active_hoppers'] == list(active_hoppers) and \
+        solution['active_reclaimers'] == list(active_reclaimers) and \
+        solution['active_outloadings'] == list(active_outloadings)
+
+
+def route_flows(solution):
+    # Hopper/reclaimer -> outloading tonnage, summed over jetties
+    routes = {}
+    for (h, j, o), f in solution['flow'].items():
+        if f > 0:
+            routes[h, o] = routes.get((h, o), 0) + f
+    for (r, j, o), f in solution['reclaim_flow'].items():
+        if f > 0:
+            routes[r, o] = routes.get((r, o), 0) + f
+    return routes
+
+
+def diff_solutions(previous, current, tolerance=1):
+    # Routes whose tonnage changed by at least `tolerance`, largest change first
+    before = route_flows(previous)
+    after = route_flows(current)
+    changes = []
+    for route in set(before) | set(after):
+        old, new = before.get(route, 0), after.get(route, 0)
+        if abs(new - old) >= tolerance:
+            changes.append((route[0], route[1], old, new))
+    changes.sort(key=lambda c: abs(c[3] - c[2]), reverse=True)
+    return changes
+
+
+def format_solution_diff(previous, current, changes):
+    result = ""
+    if previous['status'] != current['status']:
+        result += f"Status: {previous['status']} -> {current['status']}\n"
+    # Flows of a solve that is not Optimal are whatever CBC left behind; there is nothing to compare
+    if previous['status'] != 'Optimal' or current['status'] != 'Optimal':
+        if previous['status'] == current['status']:
+            result += f"Status: {current['status']} (no flows to compare)\n"
+        return result
+    result += f"Total tonnage: {int(previous['objective'])} -> {int(current['objective'])}/hour " \
+              f"({int(current['objective'] - previous['objective']):+d})\n"
+    if not changes:
+        result += "No flow changes\n"
+    for source, o, old, new in changes:
+        result += f"{source} to {o} | {int(old)} -> {int(new)} ({int(new - old):+d})\n"
+    return result
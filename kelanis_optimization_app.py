@@ -7,12 +7,23 @@ Created on Sat Aug 24 18:13:07 2024
 
 import sys
 import os
-import pulp
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QTextEdit, QLabel, QGroupBox
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QFont, QIcon
+import difflib
+from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QTextEdit, QLabel, QGroupBox, QComboBox, QTabWidget, QTableView, QLineEdit, QHeaderView
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+from PyQt5.QtGui import QFont, QIcon, QTextCursor, QTextFormat, QColor
 import traceback
 import logging
+from kelanis_model import format_solution, solution_matches, diff_solutions, format_solution_diff
+from kelanis_contingency import run_contingency_analysis, format_contingency_report
+from kelanis_whatif import run_whatif_analysis, format_whatif_report
+from kelanis_profiling import profile_stage
+from kelanis_sites import default_registry, SolverService
+from kelanis_history import SolveHistory
+from kelanis_feed import create_feed
+from kelanis_views import FlowTableModel, FlowDiagram, flow_proxy_model
+
+# Quiet period after the last equipment-status change before re-solving
+STATUS_DEBOUNCE_MS = 500
 
 logging.basicConfig(filename='app.log', level=logging.DEBUG)
 
@@ -37,6 +48,10 @@ def get_icon_path():
         return None
 
 class OptimizationApp(QMainWindow):
+    # Emitted from feed and solver threads; Qt delivers them on the GUI thread
+    status_received = pyqtSignal(dict)
+    solve_finished = pyqtSignal(int, object)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Kelanis Network Flow Optimization")
@@ -60,34 +75,74 @@ class OptimizationApp(QMainWindow):
         self.hopper_buttons = {}
         self.reclaimer_buttons = {}
         self.outloading_buttons = {}
+        self.last_solution = None
+
+        # Sites are loaded on first use; all of them share one solver pool and cache
+        self.site_registry = default_registry()
+        self.solver_service = SolverService(self.site_registry, history=self.open_solve_history(),
+                                            portfolio=os.environ.get('KELANIS_PORTFOLIO') == '1',
+                                            decomposition=os.environ.get('KELANIS_DECOMPOSITION') == '1')
+        self.site = self.site_registry.names()[0]
+        self.plant = self.site_registry.get(self.site)
+        self.output_lines = []
+        self.output_style = None
+
+        # Live equipment status: bursts restart the debounce timer, and every
+        # new solve bumps the generation so older results are discarded
+        self.status_feed = None
+        self.solve_generation = 0
+        self.pending_solve = None
+        self.resolve_timer = QTimer(self)
+        self.resolve_timer.setSingleShot(True)
+        self.resolve_timer.setInterval(STATUS_DEBOUNCE_MS)
+        self.resolve_timer.timeout.connect(self.start_auto_solve)
+        self.status_received.connect(self.apply_equipment_status)
+        self.solve_finished.connect(self.finish_auto_solve)
 
         self.create_input_section()
         self.create_output_section()
 
+        feed_spec = os.environ.get('KELANIS_STATUS_FEED')
+        if feed_spec:
+            try:
+                self.connect_status_feed(create_feed(feed_spec))
+            except Exception as e:
+                logging.error(f"Could not start status feed {feed_spec}: {e}")
+
         # Set font size for input widgets
         self.setStyleSheet("""
             QGroupBox { font-size: 10pt; }
             QPushButton { font-size: 9pt; }
         """)
 
+    def open_solve_history(self):
+        # Solve history lives next to app.log unless KELANIS_HISTORY_DB points elsewhere
+        path = os.environ.get('KELANIS_HISTORY_DB', 'solve_history.db')
+        if not path:
+            return None
+        try:
+            return SolveHistory(path)
+        except Exception as e:
+            logging.error(f"Could not open solve history {path}: {e}")
+            return None
+
     def create_input_section(self):
         input_group = QGroupBox("Input Options")
         input_layout = QVBoxLayout()
 
-        # Hoppers
-        hoppers = ['H1', 'H2', 'H3', 'H4', 'H5', 'H6', 'H7']
-        hopper_group = self.create_toggle_buttons(hoppers, "Hoppers")
-        input_layout.addWidget(hopper_group)
-
-        # Reclaimers
-        reclaimers = ['L3', 'L1', 'L2', 'L8', 'L21', 'L16', 'L17', 'L18', 'L19']
-        reclaimer_group = self.create_toggle_buttons(reclaimers, "Reclaimers")
-        input_layout.addWidget(reclaimer_group)
+        # Site selector
+        site_layout = QHBoxLayout()
+        site_layout.addWidget(QLabel("Site"))
+        self.site_combo = QComboBox()
+        self.site_combo.addItems(self.site_registry.names())
+        self.site_combo.currentTextChanged.connect(self.change_site)
+        site_layout.addWidget(self.site_combo)
+        site_layout.addStretch()
+        input_layout.addLayout(site_layout)
 
-        # Outloadings
-        outloadings = ['L4', 'L6', 'L26', 'L20', 'L9', 'L29']
-        outloading_group = self.create_toggle_buttons(outloadings, "Outloadings")
-        input_layout.addWidget(outloading_group)
+        self.equipment_layout = QVBoxLayout()
+        self.create_equipment_groups()
+        input_layout.addLayout(self.equipment_layout)
 
         # Add Solve and Reset buttons in a horizontal layout
         button_layout = QHBoxLayout()
@@ -99,17 +154,124 @@ class OptimizationApp(QMainWindow):
         self.reset_button.clicked.connect(self.reset_buttons)
         button_layout.addWidget(self.reset_button)
 
+        self.contingency_button = QPushButton("Contingency (N-1/N-2)")
+        self.contingency_button.clicked.connect(self.run_contingency)
+        button_layout.addWidget(self.contingency_button)
+
+        self.whatif_button = QPushButton("What-if Repairs")
+        self.whatif_button.clicked.connect(self.run_whatif)
+        button_layout.addWidget(self.whatif_button)
+
+        # Pairs of repairs take many more solves, so they are opt-in
+        self.whatif_depth = QComboBox()
+        self.whatif_depth.addItems(["Single repairs", "Single + pair repairs"])
+        button_layout.addWidget(self.whatif_depth)
+
         input_layout.addLayout(button_layout)
 
         input_group.setLayout(input_layout)
         self.layout.addWidget(input_group)
 
+    def create_equipment_groups(self):
+        # Hoppers
+        hopper_group = self.create_toggle_buttons(self.plant['hoppers'], "Hoppers")
+        self.equipment_layout.addWidget(hopper_group)
+
+        # Reclaimers
+        reclaimer_group = self.create_toggle_buttons(self.plant['reclaimers'], "Reclaimers")
+        self.equipment_layout.addWidget(reclaimer_group)
+
+        # Outloadings
+        outloading_group = self.create_toggle_buttons(self.plant['outloadings'], "Outloadings")
+        self.equipment_layout.addWidget(outloading_group)
+
+    def change_site(self, site):
+        try:
+            self.plant = self.site_registry.get(site)
+        except Exception as e:
+            error_msg = f"Could not load site {site}: {str(e)}\n\n{traceback.format_exc()}"
+            logging.error(error_msg)
+            self.set_output(error_msg, error=True)
+            return
+
+        self.site = site
+        self.setWindowTitle(f"{site} Network Flow Optimization")
+        self.supersede_pending_solve()
+        while self.equipment_layout.count():
+            self.equipment_layout.takeAt(0).widget().deleteLater()
+        self.create_equipment_groups()
+
+        self.last_solution = None
+        self.clear_output()
+
+    def closeEvent(self, event):
+        if self.status_feed is not None:
+            self.status_feed.stop()
+        self.solver_service.shutdown()
+        super().closeEvent(event)
+
+    def connect_status_feed(self, feed):
+        if self.status_feed is not None:
+            self.status_feed.stop()
+        self.status_feed = feed
+        feed.start(self.status_received.emit)
+
+    def apply_equipment_status(self, status):
+        changed = False
+        for button_dict in [self.hopper_buttons, self.reclaimer_buttons, self.outloading_buttons]:
+            for name, available in status.items():
+                button = button_dict.get(name)
+                if button is not None and button.isChecked() != available:
+                    button.setChecked(available)
+                    changed = True
+
+        # Restarting the timer coalesces a burst of changes into one solve
+        if changed:
+            self.resolve_timer.start()
+
+    def supersede_pending_solve(self):
+        self.solve_generation += 1
+        if self.pending_solve is not None:
+            self.solver_service.cancel(self.pending_solve)
+            self.pending_solve = None
+
+    def start_auto_solve(self):
+        active_hoppers, active_reclaimers, active_outloadings = self.get_active_equipment()
+        self.supersede_pending_solve()
+        generation = self.solve_generation
+
+        warm_start = None
+        if self.last_solution is not None and self.last_solution['status'] == 'Optimal':
+            warm_start = self.last_solution['values']
+        future = self.solver_service.submit(self.site, active_hoppers, active_reclaimers, active_outloadings,
+                                            warm_start=warm_start, tag='feed')
+        self.pending_solve = future
+        future.add_done_callback(lambda f: self.solve_finished.emit(generation, f))
+
+    def finish_auto_solve(self, generation, future):
+        # A newer solve has started since this one; drop its result
+        if generation != self.solve_generation or future.cancelled():
+            return
+        self.pending_solve = None
+
+        try:
+            solution = future.result()
+            previous_solution = self.last_solution
+            self.last_solution = solution
+            self.show_solution(previous_solution, solution)
+        except Exception as e:
+            error_msg = f"An error occurred: {str(e)}\n\n{traceback.format_exc()}"
+            logging.error(error_msg)
+            self.set_output(error_msg, error=True)
+
     def reset_buttons(self):
         for button_dict in [self.hopper_buttons, self.reclaimer_buttons, self.outloading_buttons]:
             for button in button_dict.values():
                 button.setChecked(True)
-        self.output_text.clear()
-        self.output_text.setStyleSheet("background-color: white; font-size: 9pt; font-family: Courier, monospace;")
+        self.resolve_timer.stop()
+        self.supersede_pending_solve()
+        self.last_solution = None
+        self.clear_output()
 
     def create_toggle_buttons(self, items, title):
         group = QGroupBox(title)
@@ -133,307 +295,247 @@ class OptimizationApp(QMainWindow):
         return group
 
     def create_output_section(self):
+        self.output_tabs = QTabWidget()
+
+        # Flow table: a view over the solution, so only visible rows are painted
+        # and a new solve only touches the cells that changed
+        flows = QWidget()
+        flows_layout = QVBoxLayout(flows)
+        header_layout = QHBoxLayout()
+        self.status_label = QLabel("")
+        header_layout.addWidget(self.status_label, 1)
+        self.flow_filter = QLineEdit()
+        self.flow_filter.setPlaceholderText("Filter (e.g. K3, L20, Reclaimer)")
+        self.flow_filter.setClearButtonEnabled(True)
+        header_layout.addWidget(self.flow_filter)
+        flows_layout.addLayout(header_layout)
+
+        self.flow_model = FlowTableModel(self)
+        self.flow_model.set_plant(self.plant)
+        self.flow_proxy = flow_proxy_model(self.flow_model, self)
+        self.flow_filter.textChanged.connect(self.flow_proxy.setFilterFixedString)
+        self.flow_table = QTableView()
+        self.flow_table.setModel(self.flow_proxy)
+        self.flow_table.setSortingEnabled(True)
+        self.flow_table.sortByColumn(FlowTableModel.TONNES, Qt.DescendingOrder)
+        self.flow_table.verticalHeader().setVisible(False)
+        self.flow_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.flow_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.flow_table.setStyleSheet("font-size: 9pt;")
+        flows_layout.addWidget(self.flow_table)
+        self.output_tabs.addTab(flows, "Flows")
+
+        self.flow_diagram = FlowDiagram()
+        self.flow_diagram.set_plant(self.plant)
+        self.output_tabs.addTab(self.flow_diagram, "Diagram")
+
+        # Text report, also used for contingency reports and errors
         self.output_text = QTextEdit()
         self.output_text.setReadOnly(True)
         self.output_text.setStyleSheet("font-size: 9pt; font-family: Courier, monospace;")
-        self.layout.addWidget(self.output_text)
+        self.output_tabs.addTab(self.output_text, "Report")
+        self.layout.addWidget(self.output_tabs)
+
+        # Route changes between the previous and the current solve
+        diff_group = QGroupBox("Changes Since Previous Solve")
+        diff_layout = QVBoxLayout()
+        self.diff_text = QTextEdit()
+        self.diff_text.setReadOnly(True)
+        self.diff_text.setMaximumHeight(150)
+        self.diff_text.setStyleSheet("font-size: 9pt; font-family: Courier, monospace;")
+        diff_layout.addWidget(self.diff_text)
+        diff_group.setLayout(diff_layout)
+        self.layout.addWidget(diff_group)
+
+    def set_output_style(self, error):
+        # Only swap the stylesheet when the background actually changes
+        style = "background-color: #FFCCCB" if error else "background-color: white"
+        if style != self.output_style:
+            self.output_text.setStyleSheet(f"{style}; font-size: 9pt; font-family: Courier, monospace;")
+            self.status_label.setStyleSheet(f"{style}; font-size: 10pt; padding: 2px;")
+            self.output_style = style
+
+    def set_output(self, text, error=False):
+        self.output_text.setPlainText(text)
+        self.output_text.setExtraSelections([])
+        self.output_lines = text.split("\n")
+        self.set_output_style(error)
+        if error:
+            # Errors have no flows to show; bring the report forward
+            self.status_label.setText("Error")
+            self.output_tabs.setCurrentWidget(self.output_text)
+
+    def clear_output(self):
+        self.set_output("")
+        self.diff_text.clear()
+        self.status_label.clear()
+        self.flow_model.set_plant(self.plant)
+        self.flow_diagram.set_plant(self.plant)
+
+    def update_output(self, text, error=False):
+        # Patch only the lines that differ from what is already displayed
+        new_lines = text.split("\n")
+        old_lines = self.output_lines
+        if not old_lines or old_lines == [""]:
+            self.set_output(text, error)
+            return
+
+        document = self.output_text.document()
+        cursor = QTextCursor(document)
+        cursor.beginEditBlock()
+        opcodes = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes()
+        # Apply from the bottom up so earlier block numbers stay valid
+        for tag, i1, i2, j1, j2 in reversed(opcodes):
+            if tag == 'equal':
+                continue
+            replacement = new_lines[j1:j2]
+            if i2 < len(old_lines):
+                cursor.setPosition(document.findBlockByNumber(i1).position())
+                cursor.setPosition(document.findBlockByNumber(i2).position(), QTextCursor.KeepAnchor)
+                cursor.insertText("".join(line + "\n" for line in replacement))
+            elif i1 > 0:
+                # Changes running to the end of the document also own the preceding newline
+                cursor.setPosition(document.findBlockByNumber(i1 - 1).position() + len(old_lines[i1 - 1]))
+                cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+                cursor.insertText("".join("\n" + line for line in replacement))
+            else:
+                cursor.select(QTextCursor.Document)
+                cursor.insertText("\n".join(replacement))
+        cursor.endEditBlock()
+        self.output_lines = new_lines
+
+        # Highlight the rows that changed
+        selections = []
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag in ('replace', 'insert'):
+                for line in range(j1, j2):
+                    selection = QTextEdit.ExtraSelection()
+                    selection.cursor = QTextCursor(document.findBlockByNumber(line))
+                    selection.format.setBackground(QColor("#FFF3B0"))
+                    selection.format.setProperty(QTextFormat.FullWidthSelection, True)
+                    selections.append(selection)
+        self.output_text.setExtraSelections(selections)
+        self.set_output_style(error)
 
     def solve_optimization(self):
+        with profile_stage('solve_optimization'):
+            self._solve_optimization()
+
+    def _solve_optimization(self):
         try:
             # Get active options
-            active_hoppers = [h for h, btn in self.hopper_buttons.items() if btn.isChecked()]
-            active_reclaimers = [r for r, btn in self.reclaimer_buttons.items() if btn.isChecked()]
-            active_outloadings = [o for o, btn in self.outloading_buttons.items() if btn.isChecked()]
+            active_hoppers, active_reclaimers, active_outloadings = self.get_active_equipment()
+            previous_solution = self.last_solution
+
+            # A manual solve supersedes any automatic one still in flight
+            self.resolve_timer.stop()
+            self.supersede_pending_solve()
     
             # Run optimization
             result, status = self.run_optimization(active_hoppers, active_reclaimers, active_outloadings)
     
             # Display results
-            self.output_text.setText(result)
-            
-            # Set background color based on status
-            if status == "Infeasible":
-                self.output_text.setStyleSheet("background-color: #FFCCCB; font-size: 9pt; font-family: Courier, monospace;")
-            else:
-                self.output_text.setStyleSheet("background-color: white; font-size: 9pt; font-family: Courier, monospace;")
+            self.show_solution(previous_solution, self.last_solution, result)
         except Exception as e:
             error_msg = f"An error occurred: {str(e)}\n\n{traceback.format_exc()}"
             logging.error(error_msg)
-            self.output_text.setText(error_msg)
-            self.output_text.setStyleSheet("background-color: #FFCCCB; font-size: 9pt; font-family: Courier, monospace;")
-
-    def run_optimization(self, active_hoppers, active_reclaimers, active_outloadings):
-        # Initialize problem
-        prob = pulp.LpProblem("Network_Flow_Optimization", pulp.LpMaximize)
-
-        # Define variables
-        jetties = {'K1': ['L4', 'L6', 'L26'], 'K3': ['L20', 'L9', 'L29']}
-        active_jetties = {j: [o for o in ol if o in active_outloadings] for j, ol in jetties.items()}
-        active_jetties = {j: ol for j, ol in active_jetties.items() if ol}
-
-        hopper_capacity = {
-            'H1': 600, 'H2': 1300, 'H3': 1150, 'H4': 1000,
-            'H5': 2300, 'H6': 1350, 'H7': 1450
-        }
-
-        reclaimer_capacity = {
-            'L3': 1050, 'L1': 1100, 'L2': 800, 'L8': 1050,
-            'L21': 1450, 'L16': 800, 'L17': 950, 'L18': 1000, 'L19': 800
-        }
-
-        outloading_target = {
-            'L4': 1400, 'L6': 1250, 'L26': 1550,
-            'L20': 2250, 'L9': 1750, 'L29': 1950
-        }
-
-
-
-        # Create decision variables
-        flow = pulp.LpVariable.dicts("flow",
-                                     ((h, j, o) for h in active_hoppers for j in active_jetties for o in active_jetties[j]),
-                                     lowBound=0,
-                                     cat='Continuous')
-
-        reclaim_flow = pulp.LpVariable.dicts("reclaim_flow",
-                                             ((r, j, o) for r in active_reclaimers for j in active_jetties for o in active_jetties[j]),
-                                             lowBound=0,
-                                             cat='Continuous')
+            self.set_output(error_msg, error=True)
+
+    def show_solution(self, previous_solution, solution, result=None):
+        # Display results, setting background color based on status
+        with profile_stage('render'):
+            if result is None:
+                result = format_solution(solution)
+            self.update_output(result, error=solution['status'] == "Infeasible")
+            # The objective of an infeasible or unsolved model means nothing
+            status = f"Status: {solution['status']}"
+            if solution['status'] == 'Optimal':
+                status += f" | Total {int(solution['objective'])}/hour"
+            # Decomposition solves report their duality gap
+            if solution.get('gap') is not None:
+                status += f" | Gap {solution['gap']:.2%} ({solution['method']})"
+            self.status_label.setText(status)
+            self.flow_model.set_solution(solution)
+            self.flow_diagram.set_solution(solution)
+            if previous_solution is not None:
+                changes = diff_solutions(previous_solution, solution)
+                self.diff_text.setPlainText(format_solution_diff(previous_solution, solution, changes))
+
+    def get_active_equipment(self):
+        active_hoppers = [h for h, btn in self.hopper_buttons.items() if btn.isChecked()]
+        active_reclaimers = [r for r, btn in self.reclaimer_buttons.items() if btn.isChecked()]
+        active_outloadings = [o for o, btn in self.outloading_buttons.items() if btn.isChecked()]
+        return active_hoppers, active_reclaimers, active_outloadings
+
+    def run_contingency(self):
+        with profile_stage('run_contingency'):
+            self._run_contingency()
+
+    def _run_contingency(self):
+        try:
+            active_hoppers, active_reclaimers, active_outloadings = self.get_active_equipment()
+
+            # Reuse the displayed solution as the base case when it matches the current toggles
+            base_solution = self.last_solution
+            if not solution_matches(base_solution, active_hoppers, active_reclaimers, active_outloadings):
+                base_solution = None
+
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+            try:
+                base_solution, results = run_contingency_analysis(active_hoppers, active_reclaimers, active_outloadings,
+                                                                  base_solution=base_solution, plant=self.plant,
+                                                                  service=self.solver_service)
+            finally:
+                QApplication.restoreOverrideCursor()
+
+            self.set_output(format_contingency_report(base_solution, results))
+            self.output_tabs.setCurrentWidget(self.output_text)
+        except Exception as e:
+            error_msg = f"An error occurred: {str(e)}\n\n{traceback.format_exc()}"
+            logging.error(error_msg)
+            self.set_output(error_msg, error=True)
 
-        hopper_use = pulp.LpVariable.dicts("hopper_use",
-                                           ((h, o) for h in active_hoppers for o in active_outloadings),
-                                           cat='Binary')
+    def run_whatif(self):
+        with profile_stage('run_whatif'):
+            self._run_whatif()
 
-        reclaimer_use = pulp.LpVariable.dicts("reclaimer_use",
-                                              ((r, o) for r in active_reclaimers for o in active_outloadings),
-                                              cat='Binary')
-        
-        # Add new variables for the constraint H5 & L8 to L9
-        h5_to_l9 = pulp.LpVariable("h5_to_l9", cat='Binary')
-        l8_to_l9 = pulp.LpVariable("l8_to_l9", cat='Binary')
-
-        # Objective function
-        prob += pulp.lpSum(flow[h,j,o] for h in active_hoppers for j in active_jetties for o in active_jetties[j]) + \
-                pulp.lpSum(reclaim_flow[r,j,o] for r in active_reclaimers for j in active_jetties for o in active_jetties[j])
-
-        # Constraints
-        # Hopper capacity constraints
-        for h in active_hoppers:
-            prob += pulp.lpSum(flow[h,j,o] for j in active_jetties for o in active_jetties[j]) <= hopper_capacity[h]
-
-        # Reclaimer capacity constraints
-        for r in active_reclaimers:
-            prob += pulp.lpSum(reclaim_flow[r,j,o] for j in active_jetties for o in active_jetties[j]) <= reclaimer_capacity[r]
-
-        # Hopper flow constraints
-        allowed_flows = {
-            'H1': ['L4'],
-            'H2': ['L4', 'L26'],
-            'H3': ['L20'],
-            'H4': ['L20'],
-            'H5': ['L9', 'L6'],
-            'H6': ['L6', 'L26'],
-            'H7': ['L29', 'L26']
-        }
-
-        for h in active_hoppers:
-            for j in active_jetties:
-                for o in active_jetties[j]:
-                    if o not in allowed_flows[h] or o not in active_outloadings:
-                        prob += flow[h,j,o] == 0
-
-        # Reclaimer flow constraints
-        allowed_reclaim_flows = {
-            'L3': ['L4', 'L6'],
-            'L1': ['L4'],
-            'L2': ['L26'],
-            'L8': ['L9'],
-            'L21': ['L29', 'L26'],
-            'L16': ['L29', 'L26'],
-            'L17': ['L20'],
-            'L18': ['L20'],
-            'L19': ['L20']
-        }
-
-        for r in active_reclaimers:
-            for j in active_jetties:
-                for o in active_jetties[j]:
-                    if o not in allowed_reclaim_flows[r] or o not in active_outloadings:
-                        prob += reclaim_flow[r,j,o] == 0
-                    else:
-                        # Add this constraint to ensure flow is only allowed for permitted combinations
-                        prob += reclaim_flow[r,j,o] <= reclaimer_capacity[r] * reclaimer_use[r,o]
-
-        # Ensure reclaimer is only used for allowed outloadings
-        for r in active_reclaimers:
-            for o in active_outloadings:
-                if o not in allowed_reclaim_flows[r]:
-                    prob += reclaimer_use[r,o] == 0
-
-        # Outloading target constraints
-        for o in active_outloadings:
-            prob += pulp.lpSum(flow[h,j,o] for h in active_hoppers for j in active_jetties if o in active_jetties[j]) + \
-                    pulp.lpSum(reclaim_flow[r,j,o] for r in active_reclaimers for j in active_jetties if o in active_jetties[j]) >= 0.8 * outloading_target[o]
-            prob += pulp.lpSum(flow[h,j,o] for h in active_hoppers for j in active_jetties if o in active_jetties[j]) + \
-                    pulp.lpSum(reclaim_flow[r,j,o] for r in active_reclaimers for j in active_jetties if o in active_jetties[j]) <= 1.7 * outloading_target[o]
-
-        # Hopper usage constraints
-        for h in active_hoppers:
-            # Ensure each hopper is used exactly once
-            prob += pulp.lpSum(hopper_use[h,o] for o in active_outloadings) == 1
-
-            # Link flow to usage and ensure at least 10% capacity utilization when used
-            for o in active_outloadings:
-                prob += pulp.lpSum(flow[h,j,o] for j in active_jetties if o in active_jetties[j]) >= 0.9 * hopper_capacity[h] * hopper_use[h,o]
-                prob += pulp.lpSum(flow[h,j,o] for j in active_jetties if o in active_jetties[j]) <= 1.2 * hopper_capacity[h] * hopper_use[h,o]
-
-        # Add the new constraint for H5 and L8 to L9
-        if 'H5' in active_hoppers and 'L8' in active_reclaimers and 'L9' in active_outloadings:
-            # Link h5_to_l9 to the actual flow
-            for j in active_jetties:
-                if 'L9' in active_jetties[j]:
-                    prob += flow['H5', j, 'L9'] <= hopper_capacity['H5'] * h5_to_l9
-                    prob += flow['H5', j, 'L9'] >= h5_to_l9  # Ensure h5_to_l9 is 1 if there's any flow
-
-            # Link l8_to_l9 to the actual flow
-            for j in active_jetties:
-                if 'L9' in active_jetties[j]:
-                    prob += reclaim_flow['L8', j, 'L9'] <= reclaimer_capacity['L8'] * l8_to_l9
-                    prob += reclaim_flow['L8', j, 'L9'] >= l8_to_l9  # Ensure l8_to_l9 is 1 if there's any flow
-
-            # Add the constraint: H5 and L8 cannot both send to L9 simultaneously
-            prob += h5_to_l9 + l8_to_l9 <= 1
-
-        # Ensure flow is zero if hopper is not used
-            for j in active_jetties:
-                for o in active_jetties[j]:
-                    prob += flow[h,j,o] <= hopper_capacity[h] * hopper_use[h,o]
-
-        # Reclaimer usage constraints
-        for r in active_reclaimers:
-            # Ensure each reclaimer is used at most once
-            prob += pulp.lpSum(reclaimer_use[r,o] for o in active_outloadings) <= 1
-
-            # Link flow to usage
-            for o in active_outloadings:
-                prob += pulp.lpSum(reclaim_flow[r,j,o] for j in active_jetties if o in active_jetties[j]) <= reclaimer_capacity[r] * reclaimer_use[r,o]
-
-            # Ensure flow is zero if reclaimer is not used
-            for j in active_jetties:
-                for o in active_jetties[j]:
-                    prob += reclaim_flow[r,j,o] <= reclaimer_capacity[r] * reclaimer_use[r,o]
-            
-        # Additional constraint L16 & L21
-        if 'L16' in active_reclaimers and 'L21' in active_reclaimers:
-            # L16 and L21 can be used simultaneously for the same outloading
-            for o in ['L29', 'L26']:
-                if o in active_outloadings:
-                    # No restriction for simultaneous use on the same outloading
-                    pass
-
-            # L16 and L21 cannot be used simultaneously for different outloadings
-            if 'L29' in active_outloadings and 'L26' in active_outloadings:
-                prob += reclaimer_use['L16','L29'] + reclaimer_use['L21','L26'] <= 1
-                prob += reclaimer_use['L16','L26'] + reclaimer_use['L21','L29'] <= 1
-
-            # Ensure that at most one of L16 or L21 is used if outloadings are different
-            # Create a new binary variable for each outloading
-            min_use = pulp.LpVariable.dicts("min_use", (o for o in active_outloadings), cat='Binary')
-            
-            for o in active_outloadings:
-                # Ensure min_use[o] is less than or equal to both reclaimer_use['L16',o] and reclaimer_use['L21',o]
-                prob += min_use[o] <= reclaimer_use['L16',o]
-                prob += min_use[o] <= reclaimer_use['L21',o]
-                
-                # Ensure min_use[o] is greater than or equal to reclaimer_use['L16',o] + reclaimer_use['L21',o] - 1
-                # This constraint, combined with the two above, ensures min_use[o] = min(reclaimer_use['L16',o], reclaimer_use['L21',o])
-                prob += min_use[o] >= reclaimer_use['L16',o] + reclaimer_use['L21',o] - 1
-
-            # Add the constraint using the new min_use variables
-            prob += pulp.lpSum(reclaimer_use['L16',o] for o in active_outloadings) + \
-                    pulp.lpSum(reclaimer_use['L21',o] for o in active_outloadings) <= 1 + \
-                    pulp.lpSum(min_use[o] for o in active_outloadings)
-
-        # Percentage constraints for Hopper and Reclaimer on Jetty K1
-        if 'K1' in active_jetties:
-            target_outloading_K1 = sum(outloading_target[o] for o in active_jetties['K1'])
-            hopper_K1 = pulp.lpSum(flow[h,'K1',o] for h in active_hoppers for o in active_jetties['K1'])
-            reclaimer_K1 = pulp.lpSum(reclaim_flow[r,'K1',o] for r in active_reclaimers for o in active_jetties['K1'])
-
-            prob += hopper_K1 >= 0 * target_outloading_K1
-            prob += hopper_K1 <= 1.0 * target_outloading_K1
-            prob += reclaimer_K1 >= 0 * target_outloading_K1
-            prob += reclaimer_K1 <= 1.0 * target_outloading_K1
-
-           # Percentage constraints for Hopper and Reclaimer on Jetty K3
-        if 'K3' in active_jetties:
-            target_outloading_K3 = sum(outloading_target[o] for o in active_jetties['K3'])
-            hopper_K3 = pulp.lpSum(flow[h,'K3',o] for h in active_hoppers for o in active_jetties['K3'])
-            reclaimer_K3 = pulp.lpSum(reclaim_flow[r,'K3',o] for r in active_reclaimers for o in active_jetties['K3'])
-
-            prob += hopper_K3 >= 0.6 * target_outloading_K3
-            prob += hopper_K3 <= 1.0 * target_outloading_K3
-            prob += reclaimer_K3 >= 0 * target_outloading_K3
-            prob += reclaimer_K3 <= 1.0 * target_outloading_K3
-
-        # Solve the problem
-        prob.solve()
-        
-        # Get the status
-        status = pulp.LpStatus[prob.status]
+    def _run_whatif(self):
+        try:
+            active_hoppers, active_reclaimers, active_outloadings = self.get_active_equipment()
+
+            # The base case goes through run_optimization, so a displayed solution is reused as is
+            previous_solution = self.last_solution
+            self.run_optimization(active_hoppers, active_reclaimers, active_outloadings)
+            if self.last_solution is not previous_solution:
+                self.show_solution(previous_solution, self.last_solution)
+
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+            try:
+                base_solution, results = run_whatif_analysis(active_hoppers, active_reclaimers, active_outloadings,
+                                                             base_solution=self.last_solution,
+                                                             max_repairs=self.whatif_depth.currentIndex() + 1,
+                                                             plant=self.plant, service=self.solver_service)
+            finally:
+                QApplication.restoreOverrideCursor()
+
+            self.set_output(format_whatif_report(base_solution, results))
+            self.output_tabs.setCurrentWidget(self.output_text)
+        except Exception as e:
+            error_msg = f"An error occurred: {str(e)}\n\n{traceback.format_exc()}"
+            logging.error(error_msg)
+            self.set_output(error_msg, error=True)
 
-        # Format and return results
-        result = f"Status: {pulp.LpStatus[prob.status]}\n"
-        result += "-----" * 30 + "\n"
-    
-        for j, outloadings_j in active_jetties.items():
-            result += f"\nJetty {j} Summary:\n"
-    
-            # Calculate total target outloading for the jetty
-            target_outloading_j = sum(outloading_target[o] for o in outloadings_j)
-    
-            # Calculate Hopper summary
-            hopper_total = sum(flow[h,j,o].value() for h in active_hoppers for o in outloadings_j)
-            reclaimer_total = sum(reclaim_flow[r,j,o].value() for r in active_reclaimers for o in outloadings_j)
-            total_tonnage = hopper_total + reclaimer_total
-            hopper_percentage = (hopper_total / total_tonnage) * 100 if total_tonnage > 0 else 0
-            result += f"\nTotal tonase Hopper to Jetty {j}: {int(hopper_total)} | Persentase Hopper terhadap Reclaimer: {hopper_percentage:.0f}%\n"
-    
-            hopper_flows = []
-            for h in active_hoppers:
-                for o in outloadings_j:
-                    if flow[h,j,o].value() > 0:
-                        hopper_flows.append((h, o, flow[h,j,o].value()))
-    
-            for i, (h, o, f) in enumerate(sorted(hopper_flows, key=lambda x: x[2], reverse=True), 1):
-                result += f"{i}. {h} to {o} | {int(f)}\n"
-    
-            # Calculate Reclaimer summary
-            reclaimer_percentage = (reclaimer_total / total_tonnage) * 100 if total_tonnage > 0 else 0
-            result += f"\nTotal tonase Reclaimer to Jetty {j}: {int(reclaimer_total)} | Persentase Reclaimer terhadap Hopper: {reclaimer_percentage:.0f}%\n"
-    
-            reclaimer_flows = []
-            for r in active_reclaimers:
-                for o in outloadings_j:
-                    if reclaim_flow[r,j,o].value() > 0:
-                        reclaimer_flows.append((r, o, reclaim_flow[r,j,o].value()))
-    
-            for i, (r, o, f) in enumerate(sorted(reclaimer_flows, key=lambda x: x[2], reverse=True), 1):
-                result += f"{i}. {r} to {o} | {int(f)}\n"
-    
-            # Print total tonnage for each outloading line
-            result += "\n"
-            total_jetty_tonnage = sum(sum(flow[h,j,o].value() for h in active_hoppers) + sum(reclaim_flow[r,j,o].value() for r in active_reclaimers)
-                          for o in outloadings_j)
-            result += f"Total tonnage for Jetty {j} = {int(total_jetty_tonnage)}/hour\n"
-            result += "-----" * 30 + "\n"
-    
-        result += "\nOverall Summary:\n"
-        for o in active_outloadings:
-            total_tonnage = sum(flow[h,j,o].value() for h in active_hoppers for j in active_jetties if o in active_jetties[j]) + \
-                            sum(reclaim_flow[r,j,o].value() for r in active_reclaimers for j in active_jetties if o in active_jetties[j])
-            result += f"{o} = {int(total_tonnage)}/hour\n"
-    
-        return result, status
+    def run_optimization(self, active_hoppers, active_reclaimers, active_outloadings):
+        with profile_stage('run_optimization'):
+            # The model is deterministic, so an unchanged configuration needs no re-solve
+            if solution_matches(self.last_solution, active_hoppers, active_reclaimers, active_outloadings):
+                solution = self.last_solution
+            else:
+                solution = self.solver_service.solve(self.site, active_hoppers, active_reclaimers, active_outloadings)
+            self.last_solution = solution
+            with profile_stage('format_solution'):
+                result = format_solution(solution)
+        return result, solution['status']
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Portfolio solving: race several solver configurations on the same scenario
+and keep the first proven answer. CBC runs are asyncio subprocesses, so the
+losing configurations are killed as soon as a winner is known.
+
+Once a scenario class has enough recorded wins, only the configurations that
+won it most often are raced. When fewer entries may run at once than are
+raced, the rest start in order of past wins as earlier ones finish unproven.
+
+Usage:
+    python kelanis_portfolio.py [--down H3,L17] [--site NAME] [--stats]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import pulp
+
+from kelanis_model import KELANIS_PLANT, build_formulation, apply_warm_start, finish_solve, record_solve, snapshot_model
+from kelanis_profiling import profile_stage
+
+# Each entry is one way of solving the model; `options` are CBC command-line options
+# and `formulation` picks the model builder (kelanis_model.FORMULATIONS)
+PORTFOLIO = [
+    {'name': 'cbc-default', 'options': []},
+    {'name': 'cbc-no-preprocess', 'options': ['preprocess off']},
+    {'name': 'cbc-depth-first', 'options': ['nodeStrategy depth']},
+    {'name': 'cbc-strategy-2', 'options': ['strategy 2']},
+    {'name': 'cbc-no-cuts', 'options': ['cuts off', 'heuristics on']},
+    {'name': 'cbc-tight', 'options': [], 'formulation': 'tight'},
+]
+
+# Race only the TOP_ENTRIES most frequent winners once a class has MIN_WINS recorded wins
+MIN_WINS = 20
+TOP_ENTRIES = 2
+
+
+def scenario_class(plant, active_hoppers, active_reclaimers, active_outloadings):
+    # Scenarios are grouped by how many of each equipment type are down
+    return (f"{plant['name']}:H-{len(plant['hoppers']) - len(active_hoppers)}"
+            f"/R-{len(plant['reclaimers']) - len(active_reclaimers)}"
+            f"/O-{len(plant['outloadings']) - len(active_outloadings)}")
+
+
+def select_portfolio(portfolio, history, klass, min_wins=MIN_WINS, top_entries=TOP_ENTRIES):
+    # Most frequent winners of this scenario class first; only the top few once the record is long enough
+    if history is None:
+        return list(portfolio)
+    wins = history.portfolio_wins(klass)
+    ordered = sorted(portfolio, key=lambda entry: -wins.get(entry['name'], 0))
+    if sum(wins.values()) >= min_wins:
+        ordered = [entry for entry in ordered[:top_entries] if wins.get(entry['name'])] or ordered
+    return ordered
+
+
+async def run_entry(entry, active_hoppers, active_reclaimers, active_outloadings, plant, warm_start, time_limit):
+    # Profiling stages only cover code between awaits, so the racing entries never interleave inside one
+    with profile_stage('build_model'):
+        prob, active_jetties, variables = build_formulation(active_hoppers, active_reclaimers, active_outloadings,
+                                                            plant, entry.get('formulation'))
+    solver = pulp.PULP_CBC_CMD(msg=False, options=list(entry['options']), timeLimit=time_limit)
+    tmp_mps, tmp_sol, tmp_mst = solver.create_tmp_files(prob.name, "mps", "sol", "mst")
+    vs, variable_names, constraint_names, _ = prob.writeMPS(tmp_mps, rename=1)
+
+    # Same command line pulp builds for CBC, but we own the process so it can be killed
+    args = [solver.path, tmp_mps] + (['-max'] if prob.sense == pulp.LpMaximize else []) + ['-timeMode', 'elapsed']
+    if warm_start and apply_warm_start(prob, warm_start):
+        solver.writesol(tmp_mst, prob, vs, variable_names, constraint_names)
+        args += ['-mips', tmp_mst]
+    if time_limit is not None:
+        args += ['-sec', str(time_limit)]
+    for option in entry['options']:
+        args += ('-' + option).split()
+    # Only the winner's bundle is recorded, but the snapshot has to be taken before solving
+    model_dict = snapshot_model(prob)
+    args += ['-solve', '-printingOptions', 'all', '-solution', tmp_sol]
+
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                   stdout=asyncio.subprocess.DEVNULL,
+                                                   stderr=asyncio.subprocess.DEVNULL)
+    try:
+        returncode = await process.wait()
+    except asyncio.CancelledError:
+        # Lost the race
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        solver.delete_tmp_files(tmp_mps, tmp_sol, tmp_mst)
+        raise
+    solve_time = time.perf_counter() - start
+
+    try:
+        if returncode != 0 or not os.path.exists(tmp_sol):
+            raise pulp.PulpSolverError(f"CBC exited with code {returncode} for {entry['name']}")
+        status, values, _, _, _, sol_status = solver.readsol_MPS(tmp_sol, prob, vs, variable_names, constraint_names)
+        prob.assignVarsVals(values)
+        prob.assignStatus(status, sol_status)
+    finally:
+        solver.delete_tmp_files(tmp_mps, tmp_sol, tmp_mst)
+
+    solution = finish_solve(prob, active_hoppers, active_reclaimers, active_outloadings, active_jetties, variables,
+                            plant, solver, solve_time)
+    solution['winner'] = entry['name']
+    # A proven answer is a validated optimum or proven infeasibility
+    valid = prob.status != pulp.LpStatusOptimal or prob.valid(eps=1e-4)
+    solution['proven'] = valid and (prob.sol_status == pulp.LpSolutionOptimal or prob.status == pulp.LpStatusInfeasible)
+    solution['valid'] = valid
+    return solution, model_dict, solver
+
+
+async def race(portfolio, active_hoppers, active_reclaimers, active_outloadings, plant, warm_start, time_limit,
+               max_concurrent=None):
+    # At most `max_concurrent` CBC processes at a time; waiting entries start in portfolio order
+    slots = asyncio.Semaphore(max_concurrent or len(portfolio))
+    running = set()
+
+    async def run(entry):
+        async with slots:
+            running.add(entry['name'])
+            try:
+                result = await run_entry(entry, active_hoppers, active_reclaimers, active_outloadings, plant,
+                                         warm_start, time_limit)
+            finally:
+                running.discard(entry['name'])
+            # Entries still running when this one finished, itself included
+            result[0]['competitors'] = len(running) + 1
+            return result
+
+    tasks = [asyncio.ensure_future(run(entry)) for entry in portfolio]
+    finished = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                result = await next_done
+            except pulp.PulpSolverError as e:
+                logging.warning(f"Portfolio entry failed: {e}")
+                continue
+            if result[0]['proven']:
+                # Plus the entries that already finished without a proof
+                result[0]['competitors'] += len(finished)
+                return result, finished
+            finished.append(result)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Nobody proved optimality (time limit): take the best valid incumbent
+    candidates = [r for r in finished if r[0]['valid'] and r[0]['status'] == 'Optimal'] or finished
+    if not candidates:
+        raise pulp.PulpSolverError("Every portfolio entry failed")
+    return max(candidates, key=lambda r: r[0]['objective']), finished
+
+
+def solve_portfolio(active_hoppers, active_reclaimers, active_outloadings, plant=KELANIS_PLANT, warm_start=None,
+                    portfolio=PORTFOLIO, time_limit=None, history=None, max_concurrent=None):
+    klass = scenario_class(plant, active_hoppers, active_reclaimers, active_outloadings)
+    selected = select_portfolio(portfolio, history, klass)
+
+    start = time.perf_counter()
+    with profile_stage('solve'):
+        (solution, model_dict, solver), _ = asyncio.run(race(selected, active_hoppers, active_reclaimers,
+                                                             active_outloadings, plant, warm_start, time_limit,
+                                                             max_concurrent))
+    solution['race_time'] = time.perf_counter() - start
+    solution['scenario_class'] = klass
+    record_solve(model_dict, solver, solution)
+
+    # A win only says something about the configuration if another one was running against it
+    if history is not None and solution['proven'] and solution['competitors'] > 1:
+        history.record_portfolio_win(plant['name'], klass, solution['winner'], solution['solve_time'])
+    return solution
+
+
+def main(argv=None):
+    from kelanis_history import SolveHistory
+    from kelanis_sites import default_registry
+
+    parser = argparse.ArgumentParser(description="Race solver configurations on one scenario.")
+    parser.add_argument('--site', default=KELANIS_PLANT['name'])
+    parser.add_argument('--down', default='', help="comma-separated equipment that is out of service")
+    parser.add_argument('--time-limit', type=float, default=None)
+    parser.add_argument('--history', default=os.environ.get('KELANIS_HISTORY_DB', 'solve_history.db'))
+    parser.add_argument('--stats', action='store_true', help="print the win table instead of solving")
+    args = parser.parse_args(argv)
+
+    history = SolveHistory(args.history) if args.history else None
+    try:
+        if args.stats:
+            if history is None:
+                parser.error("--stats needs a history database")
+            for klass, name, wins, mean_time in history.portfolio_summary():
+                print(f"{klass:<32} {name:<20} {wins:>6} {mean_time:>9.3f}s")
+            return 0
+
+        plant = default_registry().get(args.site)
+        down = {name for name in args.down.split(',') if name}
+        solution = solve_portfolio([h for h in plant['hoppers'] if h not in down],
+                                   [r for r in plant['reclaimers'] if r not in down],
+                                   [o for o in plant['outloadings'] if o not in down],
+                                   plant=plant, time_limit=args.time_limit, history=history)
+        print(f"{solution['scenario_class']}: {solution['status']} {solution['objective']:.0f}/hour, "
+              f"won by {solution['winner']} in {solution['solve_time']:.3f}s "
+              f"(race {solution['race_time']:.3f}s, proven: {solution['proven']})")
+    finally:
+        if history is not None:
+            history.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
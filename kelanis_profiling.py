@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in CPU and memory profiling for the optimization pipeline.
+
+Set KELANIS_PROFILE_DIR to a directory to enable it. Every outermost stage
+(e.g. a Solve click, or a solve on a SolverService worker) writes a CPU
+profile and a tracemalloc snapshot, and each nested stage appends its wall
+time and memory use to stages.jsonl. Each thread profiles its own stages;
+memory figures are process-wide, so they overlap while threads run together.
+KELANIS_PROFILER selects the CPU profiler: 'cprofile' (default) or
+'pyinstrument' if it is installed.
+
+Usage:
+    python kelanis_profiling.py summary PROFILE_DIR
+    python kelanis_profiling.py compare OLD.prof NEW.prof
+    python kelanis_profiling.py compare OLD.tracemalloc NEW.tracemalloc
+"""
+
+import argparse
+import cProfile
+import json
+import logging
+import os
+import pstats
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+_local = threading.local()
+# tracemalloc is process-wide: the first outermost stage starts it and the last one stops it
+_lock = threading.Lock()
+_tracing_stages = 0
+_started_tracing = False
+
+
+def profile_dir():
+    return os.environ.get('KELANIS_PROFILE_DIR')
+
+
+def _start_cpu_profiler():
+    if os.environ.get('KELANIS_PROFILER', 'cprofile') == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logging.warning("pyinstrument is not installed, falling back to cProfile")
+        else:
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows one cProfile at a time; this thread goes without a CPU profile
+        return None
+    return profiler
+
+
+def _stop_cpu_profiler(profiler, path):
+    if profiler is None:
+        return
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        profiler.dump_stats(path + '.prof')
+    else:
+        profiler.stop()
+        with open(path + '.html', 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+
+
+def _start_tracing():
+    global _tracing_stages, _started_tracing
+    with _lock:
+        if _tracing_stages == 0:
+            _started_tracing = not tracemalloc.is_tracing()
+            if _started_tracing:
+                tracemalloc.start()
+        _tracing_stages += 1
+
+
+def _stop_tracing():
+    global _tracing_stages
+    with _lock:
+        _tracing_stages -= 1
+        if _tracing_stages == 0 and _started_tracing:
+            tracemalloc.stop()
+
+
+@contextmanager
+def profile_stage(name):
+    directory = profile_dir()
+    if not directory:
+        yield
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+
+    outermost = not stack
+    if outermost:
+        os.makedirs(directory, exist_ok=True)
+        thread = threading.current_thread()
+        suffix = '' if thread is threading.main_thread() else f"-{thread.name}"
+        _local.run = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{name}{suffix}"
+        _start_tracing()
+        profiler = _start_cpu_profiler()
+
+    frame = {'name': name, 'peak': 0}
+    stack.append(frame)
+    path = "/".join(stage['name'] for stage in stack)
+    memory_before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        memory_after, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, frame['peak'])
+        stack.pop()
+        # Nested stages reset the peak counter, so hand our peak up to the parent
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+
+        record = {
+            'run': _local.run,
+            'thread': threading.current_thread().name,
+            'stage': path,
+            'wall': wall,
+            'memory_delta': memory_after - memory_before,
+            'memory_peak': peak - memory_before,
+        }
+        try:
+            with _lock:
+                with open(os.path.join(directory, 'stages.jsonl'), 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + '\n')
+
+            if outermost:
+                base = os.path.join(directory, _local.run)
+                _stop_cpu_profiler(profiler, base)
+                tracemalloc.take_snapshot().dump(base + '.tracemalloc')
+        except OSError as e:
+            logging.error(f"Could not write profile output: {e}")
+        finally:
+            if outermost:
+                _stop_tracing()
+
+
+def summarize(directory):
+    stages = {}
+    with open(os.path.join(directory, 'stages.jsonl'), encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            stages.setdefault(record['stage'], []).append(record)
+
+    print(f"{'stage':<60} {'runs':>5} {'median ms':>10} {'max ms':>10} {'peak KiB':>10}")
+    for stage, records in sorted(stages.items()):
+        walls = [r['wall'] * 1000 for r in records]
+        peak = max(r['memory_peak'] for r in records) / 1024
+        print(f"{stage:<60} {len(records):>5} {statistics.median(walls):>10.2f} {max(walls):>10.2f} {peak:>10.1f}")
+
+
+def compare_profiles(old_path, new_path, limit=25):
+    old = pstats.Stats(old_path).stats
+    new = pstats.Stats(new_path).stats
+
+    # stats maps function -> (calls, primitive calls, total time, cumulative time, callers)
+    rows = []
+    for func in set(old) | set(new):
+        old_cum = old[func][3] if func in old else 0
+        new_cum = new[func][3] if func in new else 0
+        old_calls = old[func][1] if func in old else 0
+        new_calls = new[func][1] if func in new else 0
+        rows.append((new_cum - old_cum, old_cum, new_cum, old_calls, new_calls, func))
+    rows.sort(key=lambda row: abs(row[0]), reverse=True)
+
+    print(f"{'delta s':>9} {'old s':>9} {'new s':>9} {'old calls':>10} {'new calls':>10}  function")
+    for delta, old_cum, new_cum, old_calls, new_calls, (filename, line, func) in rows[:limit]:
+        print(f"{delta:>+9.4f} {old_cum:>9.4f} {new_cum:>9.4f} {old_calls:>10} {new_calls:>10}  "
+              f"{os.path.basename(filename)}:{line}({func})")
+
+
+def compare_snapshots(old_path, new_path, limit=25):
+    old = tracemalloc.Snapshot.load(old_path)
+    new = tracemalloc.Snapshot.load(new_path)
+    for stat in new.compare_to(old, 'lineno')[:limit]:
+        print(stat)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect Kelanis profiling output.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    summary = subparsers.add_parser('summary', help="per-stage timing and memory from stages.jsonl")
+    summary.add_argument('directory')
+    compare = subparsers.add_parser('compare', help="diff two .prof or two .tracemalloc files")
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--limit', type=int, default=25)
+    args = parser.parse_args(argv)
+
+    if args.command == 'summary':
+        summarize(args.directory)
+    elif args.old.endswith('.tracemalloc'):
+        compare_snapshots(args.old, args.new, args.limit)
+    else:
+        compare_profiles(args.old, args.new, args.limit)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Solve bundles: persist a solve (model, solver parameters, active equipment and
+result) to a compressed file, and replay bundles headlessly to compare timing
+and objective.
+
+Recording is enabled by pointing KELANIS_RECORD_DIR at a directory.
+
+Usage:
+    python kelanis_replay.py BUNDLE_OR_DIR [BUNDLE_OR_DIR ...] [--repeat N]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import pulp
+
+from kelanis_model import solve_checked
+
+BUNDLE_VERSION = 1
+BUNDLE_SUFFIX = '.kelanis.json.gz'
+
+
+def save_bundle(directory, model_dict, solver, solution):
+    os.makedirs(directory, exist_ok=True)
+    created = datetime.now()
+    bundle = {
+        'version': BUNDLE_VERSION,
+        'created': created.isoformat(),
+        'model': model_dict,
+        'solver': solver.toDict(),
+        'site': solution.get('site'),
+        'active_hoppers': solution['active_hoppers'],
+        'active_reclaimers': solution['active_reclaimers'],
+        'active_outloadings': solution['active_outloadings'],
+        'result': {
+            'status': solution['status'],
+            'objective': solution['objective'],
+            'solve_time': solution.get('solve_time'),
+            'values': solution['values'],
+        },
+    }
+    # Parallel solves can finish in the same clock tick; the random suffix keeps their names apart
+    # and exclusive create makes sure a clash fails instead of overwriting
+    path = os.path.join(directory, f"solve-{created:%Y%m%d-%H%M%S-%f}-{uuid.uuid4().hex[:8]}{BUNDLE_SUFFIX}")
+    with gzip.open(path, 'xt', encoding='utf-8') as f:
+        json.dump(bundle, f, separators=(',', ':'))
+    return path
+
+
+def load_bundle(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        bundle = json.load(f)
+    if bundle.get('version') != BUNDLE_VERSION:
+        raise ValueError(f"Unsupported bundle version {bundle.get('version')} in {path}")
+    return bundle
+
+
+def find_bundles(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(BUNDLE_SUFFIX):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def replay_bundle(bundle):
+    _, prob = pulp.LpProblem.fromDict(bundle['model'])
+
+    # Replay with the recorded parameters, but never echo solver output
+    solver_dict = dict(bundle['solver'], msg=False)
+    solver = pulp.getSolverFromDict(solver_dict)
+
+    # Same invalid-Optimal check as live solves, or replays disagree with the recording
+    start = time.perf_counter()
+    solve_checked(prob, solver)
+    solve_time = time.perf_counter() - start
+
+    return {
+        'status': pulp.LpStatus[prob.status],
+        'objective': pulp.value(prob.objective) or 0,
+        'solve_time': solve_time,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded Kelanis solve bundles.")
+    parser.add_argument('paths', nargs='+', help="bundle files or directories of bundles")
+    parser.add_argument('--repeat', type=int, default=1, help="solve each bundle N times and keep the fastest")
+    parser.add_argument('--tolerance', type=float, default=1e-6, help="allowed objective difference")
+    args = parser.parse_args(argv)
+
+    mismatches = 0
+    print(f"{'bundle':<48} {'status':<12} {'objective':>12} {'recorded':>12} {'time':>8} {'rec time':>8}")
+    for path in find_bundles(args.paths):
+        bundle = load_bundle(path)
+        recorded = bundle['result']
+        replays = [replay_bundle(bundle) for _ in range(max(args.repeat, 1))]
+        replayed = min(replays, key=lambda r: r['solve_time'])
+
+        match = replayed['status'] == recorded['status'] and \
+            abs(replayed['objective'] - recorded['objective']) <= args.tolerance
+        if not match:
+            mismatches += 1
+
+        recorded_time = recorded['solve_time'] if recorded['solve_time'] is not None else float('nan')
+        print(f"{os.path.basename(path):<48} {replayed['status']:<12} {replayed['objective']:>12.1f} "
+              f"{recorded['objective']:>12.1f} {replayed['solve_time']:>8.3f} {recorded_time:>8.3f}"
+              f"{'' if match else '  MISMATCH'}")
+
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-site support: a lazily loaded registry of plant definitions and a
+solver service shared by every site.
+
+Additional sites are JSON files in the `sites` folder next to the app (or in
+KELANIS_SITES_DIR) using the same keys as kelanis_model.KELANIS_PLANT. A file
+is only read when its site is first used.
+"""
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pulp
+
+from kelanis_decomposition import solve_decomposed
+from kelanis_model import KELANIS_PLANT, solve_network_flow
+from kelanis_portfolio import solve_portfolio
+from kelanis_profiling import profile_stage
+
+# Solves a user is waiting for; in portfolio mode only these are raced
+INTERACTIVE_TAGS = ('solve', 'feed')
+
+PLANT_KEYS = ['hoppers', 'reclaimers', 'outloadings', 'jetties', 'hopper_capacity', 'reclaimer_capacity',
+              'outloading_target', 'allowed_flows', 'allowed_reclaim_flows', 'jetty_share']
+
+
+def load_plant_file(path):
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+
+    missing = [key for key in PLANT_KEYS if key not in data]
+    if missing:
+        raise ValueError(f"Site file {path} is missing {', '.join(missing)}")
+
+    # JSON has no tuples, so restore the shapes the model unpacks
+    plant = dict(data)
+    plant.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    plant['jetty_share'] = {j: tuple(share) for j, share in data['jetty_share'].items()}
+    plant['exclusive_pairs'] = [tuple(pair) for pair in data.get('exclusive_pairs', [])]
+    plant['paired_reclaimers'] = [(ra, rb, tuple(ol)) for ra, rb, ol in data.get('paired_reclaimers', [])]
+    return plant
+
+
+class SiteRegistry:
+    def __init__(self):
+        self._loaders = OrderedDict()
+        self._plants = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader):
+        # `loader` is only called the first time the site is requested
+        self._loaders[name] = loader
+
+    def discover(self, directory):
+        if not os.path.isdir(directory):
+            return
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.json'):
+                name = os.path.splitext(filename)[0]
+                path = os.path.join(directory, filename)
+                self.register(name, lambda path=path: load_plant_file(path))
+
+    def names(self):
+        return list(self._loaders)
+
+    def get(self, name):
+        with self._lock:
+            if name not in self._plants:
+                logging.info(f"Loading site {name}")
+                plant = self._loaders[name]()
+                plant['name'] = name
+                self._plants[name] = plant
+            return self._plants[name]
+
+
+def default_registry():
+    registry = SiteRegistry()
+    registry.register(KELANIS_PLANT['name'], lambda: dict(KELANIS_PLANT))
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    registry.discover(os.environ.get('KELANIS_SITES_DIR', os.path.join(script_dir, 'sites')))
+    return registry
+
+
+class SolverService:
+    # Shared worker pool and result cache for all sites. Requests wait in
+    # per-site queues and are handed to the pool round-robin, so one site's
+    # batch cannot starve another site's interactive solve.
+
+    def __init__(self, registry, max_workers=None, cache_size=1024, history=None, portfolio=False,
+                 decomposition=False):
+        self.registry = registry
+        self.history = history
+        # Race the solver portfolio for interactive solves instead of a single CBC run
+        self.portfolio = portfolio
+        # Or solve per jetty (kelanis_decomposition), for plants too large for one model
+        self.decomposition = decomposition
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.cache_size = cache_size
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._running = 0
+
+    def submit(self, site, active_hoppers, active_reclaimers, active_outloadings, warm_start=None, tag='solve'):
+        # Results are cached per site, keyed by the equipment configuration
+        key = (site, tuple(active_hoppers), tuple(active_reclaimers), tuple(active_outloadings))
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                future = Future()
+                future.set_result(self._cache[key])
+                return future
+            if key in self._pending and not self._pending[key].cancelled():
+                return self._pending[key]
+
+        # Fall back to configurations solved in earlier sessions
+        if self.history is not None:
+            try:
+                solution = self.history.lookup(self.registry.get(site), active_hoppers, active_reclaimers,
+                                               active_outloadings)
+            except Exception as e:
+                logging.error(f"Solve history lookup failed: {e}")
+                solution = None
+            if solution is not None:
+                with self._lock:
+                    self._store(key, solution)
+                future = Future()
+                future.set_result(solution)
+                return future
+
+        with self._lock:
+            if key in self._pending and not self._pending[key].cancelled():
+                return self._pending[key]
+            future = Future()
+            self._pending[key] = future
+            self._queues.setdefault(site, deque()).append((key, warm_start, tag, future))
+            self._dispatch()
+            return future
+
+    def solve(self, site, active_hoppers, active_reclaimers, active_outloadings, warm_start=None, tag='solve'):
+        return self.submit(site, active_hoppers, active_reclaimers, active_outloadings, warm_start, tag).result()
+
+    def cancel(self, future):
+        # Queued requests are dropped; a solve already running still finishes into the cache
+        return future.cancel()
+
+    def _dispatch(self):
+        # Called with the lock held: fill free workers, taking one request per site in turn
+        while self._running < self.max_workers and self._queues:
+            site, queue = next(iter(self._queues.items()))
+            key, warm_start, tag, future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(site)
+            else:
+                del self._queues[site]
+            if future.cancelled():
+                if self._pending.get(key) is future:
+                    del self._pending[key]
+                continue
+            self._running += 1
+            self._executor.submit(self._run, key, warm_start, tag, future)
+
+    def _run(self, key, warm_start, tag, future):
+        site, active_hoppers, active_reclaimers, active_outloadings = key
+        # Once running, a request can no longer be cancelled
+        if not future.set_running_or_notify_cancel():
+            self._finish(key, future)
+            return
+
+        try:
+            plant = self.registry.get(site)
+            # Solves run on pool threads, so each one is its own outermost profiling stage
+            with profile_stage(f'service_{tag}'):
+                if self.portfolio and tag in INTERACTIVE_TAGS:
+                    # Batch tags (contingency, what-if) already fill the pool one CBC run per worker;
+                    # racing them too would start a whole portfolio per worker
+                    solution = solve_portfolio(list(active_hoppers), list(active_reclaimers), list(active_outloadings),
+                                               plant=plant, warm_start=warm_start, history=self.history)
+                elif self.decomposition:
+                    solution = solve_decomposed(list(active_hoppers), list(active_reclaimers),
+                                                list(active_outloadings), plant=plant)
+                else:
+                    solution = solve_network_flow(list(active_hoppers), list(active_reclaimers),
+                                                  list(active_outloadings), solver=pulp.PULP_CBC_CMD(msg=False),
+                                                  warm_start=warm_start, plant=plant)
+        except Exception as e:
+            self._finish(key, future)
+            future.set_exception(e)
+            return
+
+        if self.history is not None:
+            self.history.record(plant, solution, tag)
+        self._finish(key, future, solution)
+        future.set_result(solution)
+
+    def _store(self, key, solution):
+        # Called with the lock held
+        self._cache[key] = solution
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _finish(self, key, future, solution=None):
+        with self._lock:
+            if solution is not None:
+                self._store(key, solution)
+            if self._pending.get(key) is future:
+                del self._pending[key]
+            self._running -= 1
+            self._dispatch()
+
+    def clear_cache(self, site=None):
+        with self._lock:
+            for key in [k for k in self._cache if site is None or k[0] == site]:
+                del self._cache[key]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if self.history is not None:
+            self.history.close()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic plant generator and scaling benchmark.
+
+Generated plants use the same tables as kelanis_model.KELANIS_PLANT and the
+same rule types: exclusive hopper/reclaimer pairs on an outloading (like
+H5/L8 -> L9), paired reclaimers (like L16/L21) and jetty share bounds.
+
+Usage:
+    python kelanis_synthetic.py --scales 10,25,50,100,200 [--seed 1] [--time-limit 60]
+"""
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+
+import pulp
+
+from kelanis_model import build_model, extract_solution, solve_checked
+
+
+def round_to(value, step=50):
+    return max(step, int(round(value / step)) * step)
+
+
+def generate_plant(n_hoppers=7, n_reclaimers=9, n_jetties=2, outloadings_per_jetty=3, routing_density=0.3,
+                   cross_jetty=0.1, exclusive_fraction=0.05, paired_fraction=0.1, seed=None):
+    # routing_density: chance of each extra same-jetty route per feeder
+    # cross_jetty: chance of each feeder also reaching an outloading on another jetty
+    rng = random.Random(seed)
+
+    jetties = {}
+    for j in range(1, n_jetties + 1):
+        jetties[f'K{j}'] = [f'O{j}_{k}' for k in range(1, outloadings_per_jetty + 1)]
+    outloadings = [o for ol in jetties.values() for o in ol]
+    jetty_names = list(jetties)
+
+    def routes():
+        home = jetties[rng.choice(jetty_names)]
+        allowed = [rng.choice(home)]
+        allowed += [o for o in home if o not in allowed and rng.random() < routing_density]
+        if len(jetty_names) > 1 and rng.random() < cross_jetty:
+            other = rng.choice([j for j in jetty_names if jetties[j] is not home])
+            allowed.append(rng.choice(jetties[other]))
+        return allowed
+
+    hoppers = [f'H{i}' for i in range(1, n_hoppers + 1)]
+    reclaimers = [f'R{i}' for i in range(1, n_reclaimers + 1)]
+    hopper_capacity = {h: round_to(rng.uniform(600, 2300)) for h in hoppers}
+    reclaimer_capacity = {r: round_to(rng.uniform(800, 1450)) for r in reclaimers}
+    allowed_flows = {h: routes() for h in hoppers}
+    allowed_reclaim_flows = {r: routes() for r in reclaimers}
+
+    # Exclusive pairs: a hopper and a reclaimer sharing one outloading. Every plant gets
+    # at least one of each rule type it has room for, so small scales exercise them too
+    exclusive_pairs = []
+    n_exclusive = max(1, int(n_hoppers * exclusive_fraction)) if exclusive_fraction and reclaimers else 0
+    for h in rng.sample(hoppers, min(n_exclusive, n_hoppers)):
+        o = rng.choice(allowed_flows[h])
+        r = rng.choice(reclaimers)
+        if o not in allowed_reclaim_flows[r]:
+            allowed_reclaim_flows[r].append(o)
+        exclusive_pairs.append((h, r, o))
+
+    # Paired reclaimers: two reclaimers serving the same two outloadings of one jetty
+    paired_reclaimers = []
+    shuffled = rng.sample(reclaimers, len(reclaimers))
+    n_paired = max(1, int(n_reclaimers * paired_fraction / 2)) if paired_fraction and outloadings_per_jetty >= 2 else 0
+    for k in range(min(n_paired, n_reclaimers // 2)):
+        ra, rb = shuffled[2 * k], shuffled[2 * k + 1]
+        home = jetties[rng.choice(jetty_names)]
+        if len(home) < 2:
+            continue
+        o1, o2 = rng.sample(home, 2)
+        allowed_reclaim_flows[ra] = [o1, o2]
+        allowed_reclaim_flows[rb] = [o1, o2]
+        paired_reclaimers.append((ra, rb, (o1, o2)))
+
+    # Targets follow the supply that can reach each outloading, as on the real plant
+    supply = {o: 0 for o in outloadings}
+    for h in hoppers:
+        for o in allowed_flows[h]:
+            supply[o] += hopper_capacity[h] / len(allowed_flows[h])
+    for r in reclaimers:
+        for o in allowed_reclaim_flows[r]:
+            supply[o] += 0.5 * reclaimer_capacity[r] / len(allowed_reclaim_flows[r])
+    outloading_target = {o: round_to(0.8 * supply[o]) for o in outloadings}
+
+    jetty_share = {j: (rng.choice([0, 0, 0.3, 0.6]), 1.0, 0, 1.0) for j in jetty_names}
+
+    return {
+        'name': f'Synthetic-{n_hoppers}x{n_reclaimers}x{n_jetties}',
+        'hoppers': hoppers,
+        'reclaimers': reclaimers,
+        'outloadings': outloadings,
+        'jetties': jetties,
+        'hopper_capacity': hopper_capacity,
+        'reclaimer_capacity': reclaimer_capacity,
+        'outloading_target': outloading_target,
+        'allowed_flows': allowed_flows,
+        'allowed_reclaim_flows': allowed_reclaim_flows,
+        'jetty_share': jetty_share,
+        'exclusive_pairs': exclusive_pairs,
+        'paired_reclaimers': paired_reclaimers,
+    }
+
+
+def plant_for_scale(scale, routing_density=0.3, seed=None):
+    # scale = number of hoppers; the rest grows in the proportions of Kelanis
+    return generate_plant(n_hoppers=scale, n_reclaimers=max(1, round(scale * 9 / 7)),
+                          n_jetties=max(2, scale // 8), outloadings_per_jetty=3,
+                          routing_density=routing_density, seed=seed)
+
+
+def benchmark_plant(plant, time_limit=60):
+    # Tracing may already be on for KELANIS_PROFILE_DIR profiling; leave it running then
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    memory_before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    prob, active_jetties, variables = build_model(plant['hoppers'], plant['reclaimers'], plant['outloadings'], plant)
+    build_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    build_peak = peak - memory_before
+    if started_tracing:
+        tracemalloc.stop()
+
+    solver = pulp.PULP_CBC_CMD(msg=False, timeLimit=time_limit)
+    start = time.perf_counter()
+    solve_checked(prob, solver)
+    solve_time = time.perf_counter() - start
+
+    solution = extract_solution(prob, plant['hoppers'], plant['reclaimers'], plant['outloadings'],
+                                active_jetties, variables)
+    return {
+        'plant': plant['name'],
+        'variables': len(prob.variables()),
+        'constraints': len(prob.constraints),
+        'build_time': build_time,
+        'build_peak': build_peak,
+        'solve_time': solve_time,
+        'status': solution['status'],
+        # Distinguishes a proven optimum from the incumbent at the time limit
+        'proven': prob.sol_status == pulp.LpSolutionOptimal,
+        'objective': solution['objective'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scaling benchmark on synthetic plants.")
+    parser.add_argument('--scales', default='7,14,28,56,112',
+                        help="comma-separated hopper counts; reclaimers and jetties scale with them")
+    parser.add_argument('--density', type=float, default=0.3, help="routing density")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--time-limit', type=float, default=60, help="CBC time limit per solve in seconds")
+    args = parser.parse_args(argv)
+
+    print(f"{'plant':<28} {'vars':>8} {'rows':>8} {'build s':>9} {'build MiB':>10} {'solve s':>9}  "
+          f"{'status':<12} {'proven':<6} {'objective':>12}")
+    for scale in [int(s) for s in args.scales.split(',')]:
+        plant = plant_for_scale(scale, args.density, args.seed)
+        r = benchmark_plant(plant, args.time_limit)
+        print(f"{r['plant']:<28} {r['variables']:>8} {r['constraints']:>8} {r['build_time']:>9.3f} "
+              f"{r['build_peak'] / 2 ** 20:>10.1f} {r['solve_time']:>9.3f}  {r['status']:<12} "
+              f"{'yes' if r['proven'] else 'no':<6} {r['objective']:>12.0f}",
+              flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Qt model/view widgets for solve results: a flow table model (sortable and
+filterable through a proxy) and a network diagram of hoppers/reclaimers ->
+outloadings -> jetties. Both are updated in place from one solution to the
+next, so only rows, cells and edges that changed are repainted. Solutions
+that are not Optimal carry no real flows, so they empty the table and idle
+the diagram.
+"""
+
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QSortFilterProxyModel, QRectF
+from PyQt5.QtGui import QBrush, QColor, QPainter, QPen
+from PyQt5.QtWidgets import QGraphicsScene, QGraphicsView
+
+from kelanis_model import outloading_tonnage, route_flows
+
+CHANGED_COLOR = QColor("#FFF3B0")
+HOPPER_COLOR = QColor("#1F77B4")
+RECLAIMER_COLOR = QColor("#2CA02C")
+IDLE_COLOR = QColor("#D0D0D0")
+
+
+class FlowTableModel(QAbstractTableModel):
+    # One row per hopper/reclaimer -> outloading route carrying tonnage
+    COLUMNS = ['Jetty', 'Source', 'Type', 'Outloading', 'Tonnes/hour', 'Change']
+    TONNES, CHANGE = 4, 5
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.tonnes = {}
+        self.changes = {}
+        self.kinds = {}
+        self.jetty_of = {}
+        self.solved = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        source, o = route = self.rows[index.row()]
+        column = index.column()
+        values = [self.jetty_of.get(o, ''), source, self.kinds.get(source, ''), o,
+                  self.tonnes[route], self.changes.get(route, 0)]
+
+        if role == Qt.DisplayRole:
+            if column == self.TONNES:
+                return f"{int(values[column])}"
+            if column == self.CHANGE:
+                return f"{int(values[column]):+d}" if int(values[column]) else ""
+            return values[column]
+        if role == Qt.UserRole:
+            # Raw values for the sort proxy, so numbers sort numerically
+            return values[column]
+        if role == Qt.TextAlignmentRole and column in (self.TONNES, self.CHANGE):
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        if role == Qt.BackgroundRole and int(self.changes.get(route, 0)):
+            return QBrush(CHANGED_COLOR)
+        return None
+
+    def set_plant(self, plant):
+        self.beginResetModel()
+        self.rows = []
+        self.tonnes = {}
+        self.changes = {}
+        self.solved = False
+        self.kinds = {**{h: 'Hopper' for h in plant['hoppers']}, **{r: 'Reclaimer' for r in plant['reclaimers']}}
+        self.jetty_of = {o: j for j, ol in plant['jetties'].items() for o in ol}
+        self.endResetModel()
+
+    def set_solution(self, solution):
+        # Remove, update and append rows in place instead of resetting the model
+        optimal = solution['status'] == 'Optimal'
+        tonnes = route_flows(solution) if optimal else {}
+        # Nothing counts as changed on the first optimal solution
+        changes = {route: f - self.tonnes.get(route, 0) if self.solved else 0 for route, f in tonnes.items()}
+        self.solved = optimal
+
+        for i in range(len(self.rows) - 1, -1, -1):
+            if self.rows[i] not in tonnes:
+                self.beginRemoveRows(QModelIndex(), i, i)
+                del self.rows[i]
+                self.endRemoveRows()
+
+        old_tonnes, old_changes = self.tonnes, self.changes
+        self.tonnes = tonnes
+        self.changes = changes
+        for i, route in enumerate(self.rows):
+            if bool(int(old_changes.get(route, 0))) != bool(int(changes[route])):
+                # The highlight background covers the whole row
+                first = 0
+            elif int(tonnes[route]) != int(old_tonnes[route]):
+                first = self.TONNES
+            elif int(changes[route]) != int(old_changes.get(route, 0)):
+                first = self.CHANGE
+            else:
+                continue
+            self.dataChanged.emit(self.index(i, first), self.index(i, self.CHANGE))
+
+        added = [route for route in tonnes if route not in old_tonnes]
+        if added:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(added) - 1)
+            self.rows.extend(added)
+            self.endInsertRows()
+
+
+def flow_proxy_model(model, parent=None):
+    # Sorts on raw values and filters on every column, e.g. "K3" or "L20"
+    proxy = QSortFilterProxyModel(parent)
+    proxy.setSourceModel(model)
+    proxy.setSortRole(Qt.UserRole)
+    proxy.setFilterKeyColumn(-1)
+    proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+    proxy.setDynamicSortFilter(True)
+    return proxy
+
+
+class FlowDiagram(QGraphicsView):
+    # Hoppers and reclaimers on the left, outloadings in the middle, jetties on the right
+    NODE_WIDTH, NODE_HEIGHT, ROW_SPACING, COLUMN_X = 60, 22, 30, (0, 260, 460)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setScene(QGraphicsScene(self))
+        self.setRenderHint(QPainter.Antialiasing)
+        self.setViewportUpdateMode(QGraphicsView.MinimalViewportUpdate)
+        self.nodes = {}
+        self.edges = {}
+        self.edge_values = {}
+        self.largest = None
+        self.active = None
+
+    def set_plant(self, plant):
+        scene = self.scene()
+        scene.clear()
+        self.nodes = {}
+        self.edges = {}
+        self.edge_values = {}
+        self.largest = None
+        self.active = None
+
+        columns = [list(plant['hoppers']) + list(plant['reclaimers']), list(plant['outloadings']),
+                   list(plant['jetties'])]
+        tallest = max(len(names) for names in columns)
+        for x, names in zip(self.COLUMN_X, columns):
+            # Center shorter columns against the tallest one
+            offset = (tallest - len(names)) * self.ROW_SPACING / 2
+            for i, name in enumerate(names):
+                rect = scene.addRect(QRectF(x, offset + i * self.ROW_SPACING, self.NODE_WIDTH, self.NODE_HEIGHT),
+                                     QPen(Qt.black), QBrush(Qt.white))
+                rect.setZValue(1)
+                label = scene.addSimpleText(name)
+                label.setParentItem(rect)
+                label.setPos(x + 6, offset + i * self.ROW_SPACING + 3)
+                self.nodes[name] = rect
+
+        routes = [(h, o) for h in plant['hoppers'] for o in plant['allowed_flows'][h]]
+        routes += [(r, o) for r in plant['reclaimers'] for o in plant['allowed_reclaim_flows'][r]]
+        routes += [(o, j) for j, ol in plant['jetties'].items() for o in ol]
+        colors = {**{h: HOPPER_COLOR for h in plant['hoppers']}, **{r: RECLAIMER_COLOR for r in plant['reclaimers']}}
+        for a, b in routes:
+            start = self.nodes[a].rect()
+            end = self.nodes[b].rect()
+            line = scene.addLine(start.right(), start.center().y(), end.left(), end.center().y(), QPen(IDLE_COLOR, 1))
+            line.setData(0, colors.get(a, QColor(Qt.darkGray)))
+            self.edges[a, b] = line
+        self.edge_values = {edge: 0 for edge in self.edges}
+
+    def set_solution(self, solution):
+        values = {}
+        if solution['status'] == 'Optimal':
+            values = route_flows(solution)
+            jetty_of = {o: j for j, ol in solution['active_jetties'].items() for o in ol}
+            for o, f in outloading_tonnage(solution).items():
+                if o in jetty_of:
+                    values[o, jetty_of[o]] = f
+        largest = max(values.values(), default=0) or 1
+        # Widths are relative to the largest flow, so a new maximum restyles every edge
+        rescaled = largest != self.largest
+        self.largest = largest
+
+        # Otherwise only restyle edges whose tonnage moved
+        for edge, line in self.edges.items():
+            f = values.get(edge, 0)
+            if not rescaled and int(f) == int(self.edge_values[edge]):
+                continue
+            self.edge_values[edge] = f
+            if f > 0:
+                line.setPen(QPen(line.data(0), 1 + 7 * f / largest))
+                line.setToolTip(f"{edge[0]} -> {edge[1]}: {int(f)}/hour")
+                line.setZValue(0.5)
+            else:
+                line.setPen(QPen(IDLE_COLOR, 1))
+                line.setToolTip("")
+                line.setZValue(0)
+
+        active = set(solution['active_hoppers']) | set(solution['active_reclaimers']) | \
+            set(solution['active_outloadings']) | set(solution['active_jetties'])
+        if active != self.active:
+            for name, rect in self.nodes.items():
+                rect.setBrush(QBrush(Qt.white if name in active else IDLE_COLOR))
+            self.active = active
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.fitInView(self.scene().itemsBoundingRect(), Qt.KeepAspectRatio)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+What-if repair ranking: with some equipment out of service, solve every
+configuration with one (or, optionally, two) of the inactive units brought
+back online and rank the repairs by the tonnage they recover. Solving runs
+through kelanis_contingency.solve_variants.
+"""
+
+import itertools
+
+from kelanis_contingency import format_base, solve_variants, variant_result
+from kelanis_model import KELANIS_PLANT
+
+
+def inactive_equipment(active_hoppers, active_reclaimers, active_outloadings, plant=KELANIS_PLANT):
+    units = [h for h in plant['hoppers'] if h not in active_hoppers]
+    units += [r for r in plant['reclaimers'] if r not in active_reclaimers]
+    units += [o for o in plant['outloadings'] if o not in active_outloadings]
+    return units
+
+
+def repair_cases(active_hoppers, active_reclaimers, active_outloadings, max_repairs=2, plant=KELANIS_PLANT):
+    # Every combination of 1..max_repairs inactive units coming back together
+    units = inactive_equipment(active_hoppers, active_reclaimers, active_outloadings, plant)
+    for n in range(1, max_repairs + 1):
+        for repaired in itertools.combinations(units, n):
+            yield repaired
+
+
+def restored_equipment(active_hoppers, active_reclaimers, active_outloadings, repaired, plant=KELANIS_PLANT):
+    # Keep plant order so the configurations match the app's toggles and the solver cache
+    hoppers = [h for h in plant['hoppers'] if h in active_hoppers or h in repaired]
+    reclaimers = [r for r in plant['reclaimers'] if r in active_reclaimers or r in repaired]
+    outloadings = [o for o in plant['outloadings'] if o in active_outloadings or o in repaired]
+    return hoppers, reclaimers, outloadings
+
+
+def run_whatif_analysis(active_hoppers, active_reclaimers, active_outloadings,
+                        base_solution=None, max_repairs=1, max_workers=None, plant=KELANIS_PLANT, service=None):
+    # Units already online start from their current flows; repaired units start unseeded
+    cases = list(repair_cases(active_hoppers, active_reclaimers, active_outloadings, max_repairs, plant))
+    configurations = [restored_equipment(active_hoppers, active_reclaimers, active_outloadings, repaired, plant)
+                      for repaired in cases]
+    base_solution, results = solve_variants(configurations, active_hoppers, active_reclaimers, active_outloadings,
+                                            base_solution, max_workers, plant, service, tag='whatif')
+
+    base = variant_result(base_solution)
+    for repaired, result in zip(cases, results):
+        result['repaired'] = repaired
+        result['gain'] = result['objective'] - base['objective'] if result['feasible'] else 0
+        outloadings = set(base['tonnage']) | set(result['tonnage'])
+        result['outloading_gain'] = {o: result['tonnage'].get(o, 0) - base['tonnage'].get(o, 0) for o in outloadings}
+
+    # Best repairs first; single repairs ahead of pairs with the same gain
+    results.sort(key=lambda r: (not r['feasible'], -r['gain'], len(r['repaired'])))
+    return base_solution, results
+
+
+def format_whatif_report(base_solution, results):
+    result = f"What-if Repairs ({format_base(base_solution)})\n"
+    result += "-----" * 30 + "\n"
+    if not results:
+        return result + "All equipment is online; nothing to repair.\n"
+
+    for n, title in [(1, "Single repairs"), (2, "Pairs of repairs")]:
+        cases = [r for r in results if len(r['repaired']) == n]
+        if not cases:
+            continue
+        infeasible = sum(1 for r in cases if not r['feasible'])
+        result += f"\n{title}: {len(cases)} cases, {infeasible} infeasible\n"
+
+        for i, r in enumerate(cases, 1):
+            repaired = " + ".join(r['repaired'])
+            if not r['feasible']:
+                result += f"{i}. {repaired} | {r['status']}\n"
+                continue
+            changes = ", ".join(f"{o} {int(gain):+d}" for o, gain in sorted(r['outloading_gain'].items())
+                                if abs(gain) >= 1)
+            result += f"{i}. {repaired} | {int(r['objective'])}/hour | {int(r['gain']):+d}"
+            result += f" ({changes})\n" if changes else "\n"
+        result += "-----" * 30 + "\n"
+
+    return result
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The kelanis_* modules live next to the app, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,67 @@
+import pulp
+import pytest
+
+from kelanis_history import SolveHistory
+from kelanis_model import KELANIS_PLANT, solve_network_flow
+
+
+def solve(down, plant=KELANIS_PLANT):
+    return solve_network_flow([h for h in plant['hoppers'] if h not in down],
+                              [r for r in plant['reclaimers'] if r not in down],
+                              [o for o in plant['outloadings'] if o not in down],
+                              solver=pulp.PULP_CBC_CMD(msg=False), plant=plant)
+
+
+def active(solution):
+    return solution['active_hoppers'], solution['active_reclaimers'], solution['active_outloadings']
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = SolveHistory(str(tmp_path / 'history.db'))
+    yield history
+    history.close()
+
+
+def test_lookup_returns_recorded_solution(history):
+    solution = solve(['L17'])
+    history.record(KELANIS_PLANT, solution)
+    history.flush()
+
+    stored = history.lookup(KELANIS_PLANT, *active(solution))
+    assert stored['status'] == 'Optimal'
+    assert stored['objective'] == solution['objective']
+    assert stored['flow'] == solution['flow']
+    assert history.lookup(KELANIS_PLANT, *active(solve([]))) is None
+
+
+def test_lookup_skips_unproven_solves_and_changed_plants(history):
+    solution = solve(['L17'])
+    history.record(KELANIS_PLANT, dict(solution, status='Not Solved'))
+    history.flush()
+    assert history.lookup(KELANIS_PLANT, *active(solution)) is None
+
+    history.record(KELANIS_PLANT, solution)
+    history.flush()
+    changed = dict(KELANIS_PLANT, hopper_capacity=dict(KELANIS_PLANT['hopper_capacity'], H1=700))
+    assert history.lookup(changed, *active(solution)) is None
+
+
+def test_average_outloading_tonnage(history):
+    # L20 carries 3825 t/h with L17 down; with L20 itself down too it carries nothing
+    l17_down = solve(['L17'])
+    l20_down = solve(['L17', 'L20', 'H3', 'H4'])
+    assert l20_down['status'] == 'Optimal'
+    history.record(KELANIS_PLANT, l17_down)
+    history.record(KELANIS_PLANT, l20_down)
+    # Hypothetical variants are left out unless asked for
+    history.record(KELANIS_PLANT, solve(['L17', 'L19']), tag='contingency')
+    history.flush()
+
+    assert history.average_outloading_tonnage(KELANIS_PLANT, 'L20', down=['L17']) == (pytest.approx(3825), 1)
+    assert history.average_outloading_tonnage(KELANIS_PLANT, 'L20', down=['L17'], outloading_active=False) == \
+        (pytest.approx(3825 / 2), 2)
+    _, count = history.average_outloading_tonnage(KELANIS_PLANT, 'L20', down=['L17'], tags=None)
+    assert count == 2
+    assert history.average_outloading_tonnage(KELANIS_PLANT, 'L20', down=['L17'], up=['L19']) == \
+        (pytest.approx(3825), 1)